@@ -3,13 +3,48 @@ import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.svm import SVC
 from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import SGDClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
 import torch
+from sklearn.base import is_classifier
+
+import subgraphindex as si
+import embedding as emb
+
+# classifiers trained with partial_fit on mini-batches of features instead of one fit on the full feature matrix
+streaming_classifiers = ('SGDLogisticRegression', 'SGDLinearSVM')
+# number of triples whose features are gathered at once by the streaming classifiers
+classifier_batch_size = 65536
+# passes of the streaming classifiers over the training triples
+streaming_epochs = 5
+
+def tripleIds(X, entity2embedding, relation2embedding) -> np.ndarray:
+    '''
+    rows of head, relation and tail of the (head, relation, tail) label triples in the embedding matrices, as (N,3) array
+    '''
+    X = np.asarray(X, dtype=object).reshape(-1, 3)
+    return np.stack((entity2embedding.ids(X[:, 0]), relation2embedding.ids(X[:, 1]), entity2embedding.ids(X[:, 2])), axis=1)
+
+def gatherFeatures(ids: np.ndarray, entity2embedding, relation2embedding) -> np.ndarray:
+    '''
+    embeddings of head, relation and tail side by side for (N,3) rows from tripleIds, with one gather per column
+    '''
+    return np.concatenate((entity2embedding.matrix[ids[:, 0]], relation2embedding.matrix[ids[:, 1]], entity2embedding.matrix[ids[:, 2]]), axis=1)
+
+def tripleFeatures(X, entity2embedding, relation2embedding) -> np.ndarray:
+    '''
+    classifier features of the (head, relation, tail) label triples, the embeddings of head, relation and tail side by side
+    built with one gather per column
+    '''
+    entity2embedding = emb.embeddingMatrix(entity2embedding)
+    relation2embedding = emb.embeddingMatrix(relation2embedding)
+    return gatherFeatures(tripleIds(X, entity2embedding, relation2embedding), entity2embedding, relation2embedding)
 
 def trainClassifier(X_train, Y_train, entity2embedding, relation2embedding, type='LogisticRegression'):
     '''
     Train specific Classifier
+    the streaming classifiers (SGDLogisticRegression, SGDLinearSVM) only hold classifier_batch_size features at once
     '''
     if type == 'SVC':
         clf = SVC()
@@ -21,15 +56,32 @@ def trainClassifier(X_train, Y_train, entity2embedding, relation2embedding, type
         clf = GradientBoostingClassifier()
     elif type == 'randomForest':
         clf = RandomForestClassifier()
-    X_train_emb = []
-    for tp in X_train:
-        X_train_emb.append([entity2embedding[tp[0]],relation2embedding[tp[1]],entity2embedding[tp[2]]])
-    X_train_emb = np.array(X_train_emb)
-    nsamples, nx, ny = X_train_emb.shape
-    X_train_emb = X_train_emb.reshape((nsamples,nx*ny))
+    elif type == 'SGDLogisticRegression':
+        clf = SGDClassifier(loss='log_loss')
+    elif type == 'SGDLinearSVM':
+        clf = SGDClassifier(loss='hinge')
+    if type in streaming_classifiers:
+        return trainClassifierStreamed(clf, X_train, Y_train, entity2embedding, relation2embedding)
+    X_train_emb = tripleFeatures(X_train, entity2embedding, relation2embedding)
     clf.fit(X_train_emb, Y_train)
     return clf
 
+def trainClassifierStreamed(clf, X_train, Y_train, entity2embedding, relation2embedding):
+    '''
+    train a classifier with partial_fit, the features of every shuffled mini-batch are gathered from the triple ids when needed
+    '''
+    entity2embedding = emb.embeddingMatrix(entity2embedding)
+    relation2embedding = emb.embeddingMatrix(relation2embedding)
+    triples = tripleIds(X_train, entity2embedding, relation2embedding)
+    Y_train = np.asarray(Y_train)
+    classes = np.unique(Y_train)
+    for epoch in range(streaming_epochs):
+        order = np.random.permutation(len(triples))
+        for start in range(0, len(triples), classifier_batch_size):
+            batch = order[start:start+classifier_batch_size]
+            clf.partial_fit(gatherFeatures(triples[batch], entity2embedding, relation2embedding), Y_train[batch], classes=classes)
+    return clf
+
 
 def prepareTrainTestData(pos_triples, neg_triples, triples, test_size=0.33):
     '''
@@ -55,59 +107,84 @@ def prepareTrainTestData(pos_triples, neg_triples, triples, test_size=0.33):
 def prepareTrainTestDataSplit(pos_triples, neg_triples, triples, entity_to_id_map, relation_to_id_map, test_size=0.33):
     '''
     creating data for classifier training/testing, with labels from the triples
+    positives and negatives are split on their own, every part is one (N,3) LongTensor with a tensor of its labels
     '''
-    ds_pos_X = []
-    ds_pos_y = []
-    ds_neg_X = []
-    ds_neg_y = [] 
-    ds_neg = []
-    ds_all = []
-    for t in pos_triples:
-        ds_pos_X.append(torch.tensor([[t[0],t[1],t[2]]]))
-        ds_pos_y.append(1)
-    for t in neg_triples:
-        ds_neg_X.append(torch.tensor([[t[0],t[1],t[2]]]))
-        ds_neg_y.append(0)
-    #ds_all = ds_pos + ds_neg
+    ds_pos_X = torch.as_tensor(pos_triples, dtype=torch.long).reshape(-1, 3)
+    ds_neg_X = torch.as_tensor(neg_triples, dtype=torch.long).reshape(-1, 3)
 
-    X_train_pos, X_test_pos, y_train_pos, y_test_pos = train_test_split(ds_pos_X, ds_pos_y, test_size=test_size)
+    # the positions are split instead of the triples, so the split is an index operation on the tensors
+    train_pos, test_pos = train_test_split(np.arange(ds_pos_X.shape[0]), test_size=test_size)
+    train_neg, test_neg = train_test_split(np.arange(ds_neg_X.shape[0]), test_size=test_size)
 
-    X_train_neg, X_test_neg, y_train_neg, y_test_neg = train_test_split(ds_neg_X, ds_neg_y, test_size=test_size)
+    X_train_pos, X_test_pos = ds_pos_X[train_pos], ds_pos_X[test_pos]
+    y_train_pos, y_test_pos = torch.ones(len(train_pos), dtype=torch.long), torch.ones(len(test_pos), dtype=torch.long)
+    X_train_neg, X_test_neg = ds_neg_X[train_neg], ds_neg_X[test_neg]
+    y_train_neg, y_test_neg = torch.zeros(len(train_neg), dtype=torch.long), torch.zeros(len(test_neg), dtype=torch.long)
     return X_train_pos, X_test_pos, y_train_pos, y_test_pos, X_train_neg, X_test_neg, y_train_neg, y_test_neg
 
+def entityMask(entities, entity_to_id_map, num_entities: int) -> torch.Tensor:
+    '''
+    boolean mask over the entity ids, True for the given entity labels
+    '''
+    mask = torch.zeros(num_entities, dtype=torch.bool)
+    mask[torch.LongTensor([entity_to_id_map[entity] for entity in entities if entity in entity_to_id_map])] = True
+    return mask
+
 def testClassifier(classifier, X_test, y_test, entity2embedding, relation2embedding):
     LP_test_score = []
-    index = 0
-    for tp in X_test:
-        LP_test_score.append(classifier.score([[*entity2embedding[tp[0]],*relation2embedding[tp[1]],*entity2embedding[tp[2]]]],[y_test[index]]))
-        index += 1
+    X_test_emb = tripleFeatures(X_test, entity2embedding, relation2embedding)
+    for index in range(len(X_test)):
+        LP_test_score.append(classifier.score(X_test_emb[index:index+1],[y_test[index]]))
     return LP_test_score
 
 def testClassifierSubgraphs(classifier, X_test, y_test, entity2embedding, relation2embedding, subgraphs):
-    LP_test_score = []
-    for subgraph in subgraphs:
-        bigcount = 0
-        X_test_emb = []
-        y_test_emb = []
-        index = 0
-        for tp in X_test:
-            if ((tp[0] in subgraph) or (tp[2] in subgraph)):
-                X_test_emb.append([entity2embedding[tp[0]],relation2embedding[tp[1]],entity2embedding[tp[2]]])
-                y_test_emb.append(y_test[index])
-            index += 1
-        y_test_emb = np.array(y_test_emb)
-        if X_test_emb == []:
-            LP_test_score.append(-100)
-            continue
-        if len(X_test_emb) == 1:
-            LP_test_score.append(-100)
-            continue
-        X_test_emb = np.array(X_test_emb)
-        nsamples, nx, ny = X_test_emb.shape
-        X_test_emb = X_test_emb.reshape((nsamples,nx*ny))
-        LP_test_score.append(classifier.score(X_test_emb, y_test_emb))
-        bigcount += 1
-        if bigcount % 100 == 0:
-            print(f'Have tested {bigcount} subgraphs')
-
-    return LP_test_score
\ No newline at end of file
+    '''
+    score of the classifier on the test triples touching each subgraph, -100 for subgraphs with less than two of them
+    subgraphs is a list of label sets or a SubgraphIndex, every test triple is embedded and predicted only once
+    '''
+    subgraph_index = si.subgraphIndex(subgraphs)
+    rows, subgraph_ids = subgraph_index.incidentPairs([tp[0] for tp in X_test], [tp[2] for tp in X_test])
+    counts = np.bincount(subgraph_ids, minlength=subgraph_index.num_subgraphs)
+    y_test = np.asarray(y_test)
+    used = np.unique(rows)
+    position = np.searchsorted(used, rows)
+    entity2embedding = emb.embeddingMatrix(entity2embedding)
+    relation2embedding = emb.embeddingMatrix(relation2embedding)
+    # the features are gathered in batches, never for all test triples at once
+    triples = tripleIds([X_test[i] for i in used], entity2embedding, relation2embedding)
+    def features(selected):
+        return gatherFeatures(triples[selected], entity2embedding, relation2embedding)
+
+    LP_test_score = np.full(subgraph_index.num_subgraphs, -100.0)
+    if is_classifier(classifier):
+        # the score of a classifier is its accuracy, so the predictions are grouped per subgraph
+        correct = np.zeros(len(used), dtype=bool)
+        for start in range(0, len(used), classifier_batch_size):
+            batch = np.arange(start, min(start+classifier_batch_size, len(used)))
+            correct[batch] = classifier.predict(features(batch)) == y_test[used[batch]]
+        correct_per_subgraph = np.bincount(subgraph_ids, weights=correct[position].astype(np.float64), minlength=subgraph_index.num_subgraphs)
+        measured = counts > 1
+        LP_test_score[measured] = correct_per_subgraph[measured] / counts[measured]
+    else:
+        order = np.argsort(subgraph_ids, kind='stable')
+        starts = np.cumsum(counts) - counts
+        for j in np.flatnonzero(counts > 1):
+            in_subgraph = order[starts[j]:starts[j]+counts[j]]
+            LP_test_score[j] = classifier.score(features(position[in_subgraph]), y_test[rows[in_subgraph]])
+    return LP_test_score.tolist()
+
+def bestThreshold(pos_scores: torch.Tensor, neg_scores: torch.Tensor) -> torch.Tensor:
+    '''
+    threshold of the naive classifier, the score of a negative above the lowest positive with the fewest
+    positives below and negatives above it, the highest of those if several are equally good
+    both score lists are sorted once and the errors of all candidates are counted with binary searches, O(n log n)
+    '''
+    pos_sorted = torch.sort(pos_scores.detach().flatten())[0]
+    neg_sorted = torch.sort(neg_scores.detach().flatten())[0]
+    candidates = torch.flip(neg_sorted[neg_sorted > pos_sorted[0]], dims=(0,))
+    if candidates.shape[0] == 0:
+        # no negative above the lowest positive, everything is separated at the lowest positive
+        return pos_sorted[0]
+    pos_low = torch.searchsorted(pos_sorted, candidates)
+    neg_hig = neg_sorted.shape[0] - torch.searchsorted(neg_sorted, candidates, right=True)
+    return candidates[torch.argmin(pos_low + neg_hig)]
@@ -6,22 +6,16 @@ from pykeen.triples import TriplesFactory
 import csv
 import os
 import torch
+import tripleindex as ti
 
 def fullGraphLP_basic_tail(model, LP_triples_pos, emb_train_triples, all_triples):
     LP_score_list = []
     sum = 0
     for tp in LP_triples_pos:
-        tmp_scores = dict()
-        for tail in range(emb_train_triples.num_entities):
-            tup = (tp[0],tp[1],tail)
-            if tup in all_triples and tail != tp[2]:
-                #print(f'Found pos triple that is not tested triple with tail:{tail} instead of test: {tp[2]}')
-                continue
-            ten = torch.tensor([[tp[0],tp[1],tail]])
-            score = model.score_hrt(ten)
-            score = score.detach().numpy()[0][0]
-            tmp_scores[tail] = score
-        id = max(tmp_scores, key=tmp_scores.get)
+        tails = torch.unique(torch.cat((all_triples.negativeTails(tp[0], tp[1]), torch.tensor([tp[2]]))))
+        ten = torch.stack((torch.full_like(tails, tp[0]), torch.full_like(tails, tp[1]), tails), dim=1)
+        score = model.score_hrt(ten).detach().flatten()
+        id = tails[torch.argmax(score)].item()
         if id == tp[2]:
             sum += 1
             LP_score_list.append(1)
@@ -35,17 +29,10 @@ def fullGraphLP_basic_relation(model, LP_triples_pos, emb_train_triples, all_tri
     LP_score_list = []
     sum = 0
     for tp in LP_triples_pos:
-        tmp_scores = dict()
-        for relation in range(emb_train_triples.num_relations):
-            tup = (tp[0],relation,tp[2])
-            if tup in all_triples and relation != tp[1]:
-                #print(f'Found pos triple that is not tested triple with relation:{relation} instead of test: {tp[1]}')
-                continue
-            ten = torch.tensor([[tp[0],relation,tp[2]]])
-            score = model.score_hrt(ten)
-            score = score.detach().numpy()[0][0]
-            tmp_scores[relation] = score
-        id = max(tmp_scores, key=tmp_scores.get)
+        relations = torch.unique(torch.cat((all_triples.negativeRelations(tp[0], tp[2]), torch.tensor([tp[1]]))))
+        ten = torch.stack((torch.full_like(relations, tp[0]), relations, torch.full_like(relations, tp[2])), dim=1)
+        score = model.score_hrt(ten).detach().flatten()
+        id = relations[torch.argmax(score)].item()
         if id == tp[1]:
             sum += 1
             LP_score_list.append(1)
@@ -61,10 +48,8 @@ def compare_to_related2():
     train_data = dataset.training
     validation_data = dataset.validation #0.19803063457330417
 
-    all_triples_set = set()
     all_triples_tensor = torch.cat((test_data.mapped_triples,train_data.mapped_triples))
-    for tup in all_triples_tensor.tolist():
-        all_triples_set.add((tup[0],tup[1],tup[2]))
+    all_triples_set = ti.TripleIndex(all_triples_tensor, dataset.num_entities, dataset.num_relations)
 
     result = pipeline(training=train_data,testing=test_data,validation=validation_data,model=TransE,model_kwargs=dict(embedding_dim=512, scoring_fct_norm=1),
         optimizer='Adagrad',optimizer_kwargs=dict(lr=0.04121772717931592),training_loop='LCWA',training_kwargs=dict(num_epochs=400, batch_size=128),stopper='early',
@@ -32,60 +32,39 @@ def findingRank(orderedList, key):
     return None
 
 def findingRankNegHead(orderedList, key, all_triples_set, fix):
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (fix,ele[0],ele[1])
-        if tup in all_triples_set:
-            continue
-        counter += 1
-    return None
+    ordered = np.asarray([ele[:2] for ele in orderedList], dtype=np.int64).reshape(-1, 2)
+    found = np.flatnonzero((ordered[:, 0] == key[0]) & (ordered[:, 1] == key[1]))
+    if found.shape[0] == 0:
+        return None
+    before = ordered[:found[0]]
+    known = all_triples_set.contains(np.column_stack((np.full(before.shape[0], fix), before)))
+    return int(found[0] - np.sum(known)) + 1
 
 def findingRankNegTail(orderedList, key, all_triples_set, fix):
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (ele[0],ele[1],fix)
-        if tup in all_triples_set:
-            continue
-        counter += 1
-    return None
+    ordered = np.asarray([ele[:2] for ele in orderedList], dtype=np.int64).reshape(-1, 2)
+    found = np.flatnonzero((ordered[:, 0] == key[0]) & (ordered[:, 1] == key[1]))
+    if found.shape[0] == 0:
+        return None
+    before = ordered[:found[0]]
+    known = all_triples_set.contains(np.column_stack((before, np.full(before.shape[0], fix))))
+    return int(found[0] - np.sum(known)) + 1
+
+def _topRanking(ranking, degree):
+    if degree > 0:
+        ranking = ranking[:degree]
+    return np.asarray([ele[:2] for ele in ranking], dtype=np.int64).reshape(-1, 2)
 
 def overlapHead(all_triples_set, ranking, head, degree):
-    count = 0
-    deg = degree
-    for ele in ranking:
-        tup = (head,ele[0],ele[1])
-        if tup in all_triples_set:
-            count += 1
-        deg -= 1
-        if deg == 0:
-            return count
-    return count
+    top = _topRanking(ranking, degree)
+    return int(np.sum(all_triples_set.contains(np.column_stack((np.full(top.shape[0], head), top)))))
 
 def overlapRelation(all_triples_set, ranking, relation, degree):
-    count = 0
-    deg = degree
-    for ele in ranking:
-        if (ele[0],relation,ele[1]) in all_triples_set:
-            count += 1
-        deg -= 1
-        if deg == 0:
-            return count
-    return count
+    top = _topRanking(ranking, degree)
+    return int(np.sum(all_triples_set.contains(np.column_stack((top[:, 0], np.full(top.shape[0], relation), top[:, 1])))))
 
 def overlapTail(all_triples_set, ranking, tail, degree):
-    count = 0
-    deg = degree
-    for ele in ranking:
-        if (ele[0],ele[1],tail) in all_triples_set:
-            count += 1
-        deg -= 1
-        if deg == 0:
-            return count
-    return count
+    top = _topRanking(ranking, degree)
+    return int(np.sum(all_triples_set.contains(np.column_stack((top, np.full(top.shape[0], tail))))))
 
 
 def generateKFoldSplit(full_dataset, datasetname, random_seed=None, n_split=5):
@@ -125,69 +104,42 @@ def loadKFoldSplit(ith_fold, datasetname, n_split=5):
 def createNegTripleHT(kg_triple_set, kg_triple, triples):
     '''
     Creating negative triples
-    By taking an existing triple ans swapping head and tail 
+    By taking an existing triple and replacing head and tail by random entities
     so we get a non existing triple as neg triple
     '''
-    kg_neg_triple_list = []
-    related_nodes = set()
-    lst_emb = list(range(triples.num_entities))
-    bigcount = 0
-    for pos_sample in kg_triple:
-        related_nodes.add((pos_sample[0],pos_sample[2]))
-        not_created = True
-        relation = pos_sample[1]
-        count = 0
-        did_break = False
-        while not_created:
-            if count > (0.1*len(lst_emb)):
-                did_break = True
-                break
-            head = random.choice(lst_emb)
-            tail = random.choice(lst_emb)
-            kg_neg_triple = [head,relation,tail]
-            kg_neg_triple_tuple = (head,relation,tail)
-            if (kg_neg_triple_tuple not in kg_triple_set):
-                not_created = False
-        if did_break:
-            continue
-        kg_neg_triple_list.append(kg_neg_triple)
-        bigcount += 1
-        if bigcount % 10000 == 0:
-            print(f'Have created {bigcount} neg samples')
+    kg_triple = np.asarray(kg_triple, dtype=np.int64).reshape(-1, 3)
+    related_nodes = set(zip(kg_triple[:, 0].tolist(), kg_triple[:, 2].tolist()))
+    kg_neg_triple = kg_triple.copy()
+    # positions that still need a new head and tail, redrawn until they are no known triple
+    pending = np.arange(kg_triple.shape[0])
+    while pending.shape[0] > 0:
+        kg_neg_triple[pending, 0] = np.random.randint(triples.num_entities, size=pending.shape[0])
+        kg_neg_triple[pending, 2] = np.random.randint(triples.num_entities, size=pending.shape[0])
+        pending = pending[kg_triple_set.contains(kg_neg_triple[pending])]
+    kg_neg_triple_list = kg_neg_triple.tolist()
+    print(f'Have created {len(kg_neg_triple_list)} neg samples')
 
     return kg_neg_triple_list, related_nodes
 
 def createNegTripleRelation(kg_triple_set, kg_triple, triples):
     '''
     Creating negative triples
-    By taking an existing triple ans swapping head and tail 
+    By taking an existing triple and replacing the relation by a random one
     so we get a non existing triple as neg triple
     '''
-    kg_neg_triple_list = []
-    lst_emb = list(range(triples.num_relations))
-    bigcount = 0
-    for pos_sample in kg_triple:
-        not_created = True
-        head = pos_sample[0]
-        tail = pos_sample[2]
-        count = 0
-        did_break = False
-        while not_created:
-            if count > (10 * len(lst_emb)):
-                did_break = True
-                break
-            relation = random.choice(lst_emb)
-            kg_neg_triple = [head,relation,tail]
-            kg_neg_triple_tuple = (head,relation,tail)
-            if (kg_neg_triple_tuple not in kg_triple_set):
-                not_created = False
-            count += 1
-        if did_break:
-            continue
-        kg_neg_triple_list.append(kg_neg_triple)
-        bigcount += 1
-        if bigcount % 10000 == 0:
-            print(f'Have created {bigcount} neg samples')
+    kg_triple = np.asarray(kg_triple, dtype=np.int64).reshape(-1, 3)
+    kg_neg_triple = kg_triple.copy()
+    # positions that still need a new relation, given up after 10 times the number of relations tries
+    pending = np.arange(kg_triple.shape[0])
+    count = 0
+    while pending.shape[0] > 0 and count <= (10 * triples.num_relations):
+        kg_neg_triple[pending, 1] = np.random.randint(triples.num_relations, size=pending.shape[0])
+        pending = pending[kg_triple_set.contains(kg_neg_triple[pending])]
+        count += 1
+    created = np.ones(kg_triple.shape[0], dtype=bool)
+    created[pending] = False
+    kg_neg_triple_list = kg_neg_triple[created].tolist()
+    print(f'Have created {len(kg_neg_triple_list)} neg samples')
 
     return kg_neg_triple_list
 
@@ -283,6 +235,90 @@ def getkHopneighbors(u,v,M):
     count = len(existing_triples)
     return entities, list(labels), list(between_labels), count, existing_triples
 
+# neighbour index of the graph last given to getEdgeLabels, built once per graph
+neighbour_index = None
+neighbour_index_graph = None
+
+def buildNeighbourIndex(M: nx.MultiDiGraph) -> dict:
+    '''
+    for every node its out-neighbours, each with the distinct labels of the edges to it
+    '''
+    index = defaultdict(dict)
+    for u, v, label in M.edges(data='label'):
+        labels = index[u].setdefault(v, [])
+        if label not in labels:
+            labels.append(label)
+    return index
+
+def getEdgeLabels(u, v, M: nx.MultiDiGraph) -> list:
+    '''
+    labels of all edges from u to v, the same as the between labels of getkHopneighbors but read from the neighbour index
+    '''
+    global neighbour_index
+    global neighbour_index_graph
+    if neighbour_index_graph is not M:
+        neighbour_index = buildNeighbourIndex(M)
+        neighbour_index_graph = M
+    return neighbour_index[u].get(v, [])
+
+class EdgeProjection:
+    '''
+    Compact projection of a list of (u, v) edges, built once
+    The out-neighbours of every node are kept as sorted CSR arrays, so the edges induced by
+    a set of nodes are found without building a networkx subgraph
+    '''
+    def __init__(self, heads, tails):
+        heads = list(heads)
+        tails = list(tails)
+        codes, self.nodes = pd.factorize(np.asarray(heads + tails, dtype=object))
+        self.node_id = {node: i for i, node in enumerate(self.nodes)}
+        self.heads = codes[:len(heads)]
+        self.tails = codes[len(heads):]
+        self.out_order = np.lexsort((self.tails, self.heads))
+        self.out_ptr = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.heads, minlength=len(self.nodes)), out=self.out_ptr[1:])
+
+    @classmethod
+    def fromGraph(cls, M: nx.MultiDiGraph) -> 'EdgeProjection':
+        '''
+        projection of the distinct u->v pairs of M, the edges of nx.DiGraph(M)
+        '''
+        pairs = list(dict.fromkeys(M.edges()))
+        return cls([u for u, v in pairs], [v for u, v in pairs])
+
+    def _nodeIds(self, nodes) -> np.ndarray:
+        return np.array(sorted(self.node_id[node] for node in nodes if node in self.node_id), dtype=np.int64)
+
+    def _outSlices(self, ids) -> np.ndarray:
+        starts = self.out_ptr[ids]
+        counts = self.out_ptr[ids + 1] - starts
+        pos = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.out_order[pos]
+
+    def __len__(self):
+        return len(self.heads)
+
+    def edges(self) -> list[tuple]:
+        '''
+        all edges of the projection
+        '''
+        return list(zip(self.nodes[self.heads], self.nodes[self.tails]))
+
+    def inducedEdges(self, nodes) -> np.ndarray:
+        '''
+        positions of all edges with head and tail in nodes, in the order of the edge list
+        '''
+        ids = self._nodeIds(nodes)
+        pos = self._outSlices(ids)
+        return np.sort(pos[np.isin(self.tails[pos], ids)])
+
+    def induced(self, nodes) -> list[tuple]:
+        '''
+        all (u, v) edges with u and v in nodes, the edges of nx.DiGraph(M).subgraph(nodes) for a projection of M
+        '''
+        pos = self.inducedEdges(nodes)
+        return list(zip(self.nodes[self.heads[pos]], self.nodes[self.tails[pos]]))
+
 def getTriangle(u,v,M):
 
     labels = set()
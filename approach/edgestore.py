@@ -0,0 +1,65 @@
+import os
+import shelve
+
+class EdgeScoreStore:
+    '''
+    ReliK score, head part and tail part per (u, v) edge, so every edge is scored once even if it is in many subgraphs
+    At most memory_limit edges are kept in memory, with a spill_path the others are moved to a shelve file on disk
+    '''
+    def __init__(self, memory_limit: int=2**22, spill_path: str=None):
+        self.memory = {}
+        self.memory_limit = memory_limit
+        self.spill_path = spill_path
+        self.spill = None
+
+    def _key(self, edge) -> str:
+        return f'{edge[0]}\t{edge[1]}'
+
+    def __len__(self):
+        return len(self.memory) + (len(self.spill) if self.spill is not None else 0)
+
+    def __contains__(self, edge):
+        return edge in self.memory or (self.spill is not None and self._key(edge) in self.spill)
+
+    def __getitem__(self, edge) -> tuple[float,float,float]:
+        if edge in self.memory:
+            return self.memory[edge]
+        return self.spill[self._key(edge)]
+
+    def __setitem__(self, edge, scores: tuple[float,float,float]):
+        self.memory[edge] = tuple(float(score) for score in scores)
+        if len(self.memory) > self.memory_limit and self.spill_path is not None:
+            if self.spill is None:
+                self.spill = shelve.open(self.spill_path, flag='n')
+            for stored_edge, stored_scores in self.memory.items():
+                self.spill[self._key(stored_edge)] = stored_scores
+            self.memory = {}
+
+    def missing(self, edges) -> list[tuple]:
+        '''
+        distinct edges that are not scored yet, in order of their first appearance
+        '''
+        return [edge for edge in dict.fromkeys(edges) if edge not in self]
+
+    def mean(self, edges) -> tuple[float,float,float]:
+        '''
+        mean ReliK score, head part and tail part over the given edges
+        '''
+        sums = [0, 0, 0]
+        for edge in edges:
+            for k, score in enumerate(self[edge]):
+                sums[k] += score
+        return sums[0]/len(edges), sums[1]/len(edges), sums[2]/len(edges)
+
+    def close(self):
+        '''
+        drop all scores and remove the spill file
+        '''
+        self.memory = {}
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            # only the files the dbm backends of shelve create for this path
+            for suffix in ('', '.db', '.dat', '.dir', '.bak'):
+                if os.path.isfile(self.spill_path + suffix):
+                    os.remove(self.spill_path + suffix)
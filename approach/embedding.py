@@ -12,9 +12,18 @@ from pykeen.models import ComplEx
 from pykeen.models import CompGCN
 from pykeen.models import BoxE
 from pykeen.models import TuckER
+from pykeen.models import ERModel
+from pykeen.nn.modules import TransEInteraction
+from pykeen.nn.modules import DistMultInteraction
+from pykeen.nn.modules import ComplExInteraction
+from pykeen.nn.modules import RotatEInteraction
 from pykeen.pipeline import pipeline
 import timeit
 from typing import cast
+import tripleindex as ti
+import subgraphindex as si
+import numpy as np
+import pandas as pd
 
 def getDataFromPykeen(datasetname: str='Nations'):
     '''
@@ -50,13 +59,8 @@ def getDataFromPykeen(datasetname: str='Nations'):
     relation_to_id_map = dataset.relation_to_id
     #all_triples_tensor = torch.cat((dataset.training.mapped_triples,dataset.validation.mapped_triples,dataset.testing.mapped_triples))
     all_triples_tensor = dataset.training.mapped_triples
-    all_triples_set = set[tuple[int,int,int]]()
-    for tup in all_triples_tensor.tolist():
-        all_triples_set.add((tup[0],tup[1],tup[2]))
-    for tup in dataset.validation.mapped_triples.tolist():
-        all_triples_set.add((tup[0],tup[1],tup[2]))
-    for tup in dataset.testing.mapped_triples.tolist():
-        all_triples_set.add((tup[0],tup[1],tup[2]))
+    # index of all known triples from training, validation and testing
+    all_triples_set = ti.TripleIndex(torch.cat((all_triples_tensor, dataset.validation.mapped_triples, dataset.testing.mapped_triples)), dataset.num_entities, dataset.num_relations)
     validation_triples = dataset.validation
     test_triples = dataset.testing
 
@@ -194,76 +198,149 @@ def loadModel(savename="Test", device='cuda:0'):
     model = torch.load(f"approach/trainedEmbeddings/{savename}/trained_model.pkl", map_location=device)
     return model
 
+# interactions of plain lookup embeddings, their models can be stacked by ModelEnsemble
+stackable_interactions = (TransEInteraction, DistMultInteraction, ComplExInteraction, RotatEInteraction)
+
+class ModelEnsemble:
+    '''
+    K models (e.g. of the folds) scored together, every score function returns the scores of all models with a leading K dimension
+    Models of the same kind with plain lookup embeddings (TransE, DistMult, ComplEx, RotatE) get their embedding tables stacked
+    and all K models are scored in one broadcasted pass, other models are scored one after the other
+    '''
+    def __init__(self, models: list, stack: bool=True):
+        self.models = list(models)
+        self.device = self.models[0].device
+        self.stacked = stack and self.stackable(self.models)
+        if self.stacked:
+            self.interaction = self.models[0].interaction
+            with torch.no_grad():
+                self.entity_table = torch.stack([model.entity_representations[0](indices=None).detach() for model in self.models])
+                self.relation_table = torch.stack([model.relation_representations[0](indices=None).detach() for model in self.models])
+
+    @staticmethod
+    def stackable(models: list) -> bool:
+        '''
+        whether the embedding tables of the models can be stacked and scored with one shared interaction
+        '''
+        first = models[0]
+        if not isinstance(first, ERModel) or not isinstance(first.interaction, stackable_interactions):
+            return False
+        for model in models:
+            if type(model) is not type(first) or model.device != first.device:
+                return False
+            if len(model.entity_representations) != 1 or len(model.relation_representations) != 1:
+                return False
+            if model.entity_representations[0].shape != first.entity_representations[0].shape or model.relation_representations[0].shape != first.relation_representations[0].shape:
+                return False
+            if getattr(model.interaction, 'p', None) != getattr(first.interaction, 'p', None) or getattr(model.interaction, 'power_norm', None) != getattr(first.interaction, 'power_norm', None):
+                return False
+        return True
+
+    def __len__(self):
+        return len(self.models)
+
+    def score_hrt(self, hrt_batch: torch.Tensor) -> torch.Tensor:
+        '''
+        scores of the (N,3) triples for all models, shape (K,N,1) like score_hrt of a single model
+        '''
+        if not self.stacked:
+            return torch.stack([model.score_hrt(hrt_batch) for model in self.models])
+        hrt_batch = hrt_batch.to(self.device)
+        return self.interaction(self.entity_table[:, hrt_batch[:, 0]], self.relation_table[:, hrt_batch[:, 1]], self.entity_table[:, hrt_batch[:, 2]]).unsqueeze(-1)
+
+    def score_t(self, hr_batch: torch.Tensor) -> torch.Tensor:
+        '''
+        scores of the (N,2) head relation pairs against all tails for all models, shape (K,N,num_entities)
+        '''
+        if not self.stacked:
+            return torch.stack([model.score_t(hr_batch) for model in self.models])
+        hr_batch = hr_batch.to(self.device)
+        return self.interaction(self.entity_table[:, hr_batch[:, 0]].unsqueeze(2), self.relation_table[:, hr_batch[:, 1]].unsqueeze(2), self.entity_table.unsqueeze(1))
+
+    def score_h(self, rt_batch: torch.Tensor) -> torch.Tensor:
+        '''
+        scores of the (N,2) relation tail pairs against all heads for all models, shape (K,N,num_entities)
+        '''
+        if not self.stacked:
+            return torch.stack([model.score_h(rt_batch) for model in self.models])
+        rt_batch = rt_batch.to(self.device)
+        return self.interaction(self.entity_table.unsqueeze(1), self.relation_table[:, rt_batch[:, 0]].unsqueeze(2), self.entity_table[:, rt_batch[:, 1]].unsqueeze(2))
+
+class EmbeddingMatrix:
+    '''
+    Embeddings of entities or relations as one contiguous float32 matrix with a row per id, looked up by label
+    complex embeddings are stored as real and imaginary parts side by side
+    '''
+    def __init__(self, matrix, labels):
+        matrix = np.asarray(matrix)
+        if np.iscomplexobj(matrix):
+            matrix = np.concatenate((matrix.real, matrix.imag), axis=-1)
+        self.matrix = np.ascontiguousarray(matrix.reshape(len(labels), -1), dtype=np.float32)
+        self.index = pd.Index(labels)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def __getitem__(self, label) -> np.ndarray:
+        return self.matrix[self.index.get_loc(label)]
+
+    def ids(self, labels) -> np.ndarray:
+        '''
+        row of every label, KeyError if one is not known
+        '''
+        ids = self.index.get_indexer(np.asarray(labels, dtype=object))
+        if (ids < 0).any():
+            raise KeyError(np.asarray(labels, dtype=object)[ids < 0][0])
+        return ids
+
+def embeddingMatrix(embeddings) -> EmbeddingMatrix:
+    '''
+    the embeddings as EmbeddingMatrix, a dict from label to embedding is converted, a matrix is used as it is
+    '''
+    if isinstance(embeddings, EmbeddingMatrix):
+        return embeddings
+    return EmbeddingMatrix(np.array(list(embeddings.values())), list(embeddings.keys()))
+
+def createEmbeddingMatrices(model, triples):
+    '''
+    create the entity and relation EmbeddingMatrix of a model with plain lookup embeddings, rows in order of the ids
+    '''
+    entity_labels = [triples.entity_id_to_label[eid] for eid in range(triples.num_entities)]
+    relation_labels = [triples.relation_id_to_label[rid] for rid in range(triples.num_relations)]
+    with torch.no_grad():
+        e_emb_numpy = model.entity_representations[0](indices=None).cpu().numpy()
+        r_emb_numpy = model.relation_representations[0](indices=None).cpu().numpy()
+    return EmbeddingMatrix(e_emb_numpy, entity_labels), EmbeddingMatrix(r_emb_numpy, relation_labels)
+
 def createEmbeddingMaps_TransE(model, triples):
     '''
     create maps of the embedding to the respective entities and relations, for easier reuse
     '''
-    e_emb = model.entity_embeddings.cpu()
-    entity_ids = torch.LongTensor(range(triples.num_entities))
-    e_emb_numpy = e_emb(entity_ids).detach().numpy()
-    entity2embedding = {}
-    for eid in range(triples.num_entities):
-        e = triples.entity_id_to_label[eid]
-        entity2embedding[e] = list(e_emb_numpy[eid])
-        # Sanity Check if conversion stays consistent from id to labels
-        assert triples.entity_to_id[e] == eid, 'Entity IDs not consistent'
-
-    r_emb = model.relation_embeddings.cpu()
-    relation_ids = torch.LongTensor(range(triples.num_relations))
-    r_emb_numpy = r_emb(relation_ids).detach().numpy()
-    relation2embedding = {}
-    for rid in range(triples.num_relations):
-        r = triples.relation_id_to_label[rid]
-        relation2embedding[r] = list(r_emb_numpy[rid])
-        # Sanity Check if conversion stays consistent from id to labels
-        assert triples.relation_to_id[r] == rid, 'Relation IDs not consistent'
-
-    return entity2embedding, relation2embedding
+    return createEmbeddingMatrices(model, triples)
 
 def createEmbeddingMaps_DistMult(model, triples):
     '''
     create maps of the embedding to the respective entities and relations, for easier reuse
     '''
-    e_emb = model.entity_representations
-    entity_ids = torch.LongTensor([*range(triples.num_entities)])
-    e_emb_numpy = e_emb[0](entity_ids).detach().numpy()
-    entity2embedding = {}
-    for eid in range(triples.num_entities):
-        e = triples.entity_id_to_label[eid]
-        entity2embedding[e] = list(e_emb_numpy[eid])
-        # Sanity Check if conversion stays consistent from id to labels
-        assert triples.entity_to_id[e] == eid, 'Entity IDs not consistent'
-
-    r_emb = model.relation_representations
-    relation_ids = torch.LongTensor([*range(triples.num_relations)])
-    r_emb_numpy = r_emb[0](relation_ids).detach().numpy()
-    relation2embedding = {}
-    for rid in range(triples.num_relations):
-        r = triples.relation_id_to_label[rid]
-        relation2embedding[r] = list(r_emb_numpy[rid])
-        
-        # Sanity Check if conversion stays consistent from id to labels
-        assert triples.relation_to_id[r] == rid, 'Relation IDs not consistent'
-
-    return entity2embedding, relation2embedding
+    return createEmbeddingMatrices(model, triples)
 
 def getScoreForTripleListSubgraphs(X_test, emb_train_triples, model, subgraphs):
-    score_list = []
-    for subgraph in subgraphs:
-        sum = 0
-        had_element = False
-        for tp in X_test:
-            if (tp[0] in subgraph) and (tp[2] in subgraph):
-                ten = torch.tensor([[emb_train_triples.entity_to_id[tp[0]],emb_train_triples.relation_to_id[tp[1]],emb_train_triples.entity_to_id[tp[2]]]])
-                score = model.score_hrt(ten)
-                score = score.detach().numpy()[0][0]
-                sum += score
-                had_element = True
-        if had_element:
-            score_list.append(sum)
-        else:
-            score_list.append(-1)
-    return score_list
+    '''
+    sum of the scores of the test triples inside each subgraph, -1 if there is none
+    subgraphs is a list of label sets or a SubgraphIndex, every test triple is scored only once
+    '''
+    subgraph_index = si.subgraphIndex(subgraphs)
+    pairs = subgraph_index.inducedPairs([tp[0] for tp in X_test], [tp[2] for tp in X_test])
+    scores = np.zeros(len(X_test))
+    used = np.unique(pairs[0])
+    if len(used) > 0:
+        ten = torch.tensor([[emb_train_triples.entity_to_id[X_test[i][0]],emb_train_triples.relation_to_id[X_test[i][1]],emb_train_triples.entity_to_id[X_test[i][2]]] for i in used])
+        scores[used] = model.score_hrt(ten).detach().cpu().numpy().flatten()
+    counts, sums = si.groupPairs(pairs, scores, subgraph_index.num_subgraphs)
+    return np.where(counts > 0, sums, -1).tolist()
 
 def getScoreForTripleList(X_test, emb_train_triples, model):
     score_list = []
@@ -274,60 +351,35 @@ def getScoreForTripleList(X_test, emb_train_triples, model):
         score_list.append(score)
     return score_list
 
+def baselineLPHits(subgraphs, emb_train_triples, X_test, hit) -> list[float]:
+    '''
+    share of the test triples inside each subgraph for which hit(triple) is true, -100 for subgraphs with at most two of them
+    hit is computed only once per test triple that is inside any subgraph
+    '''
+    subgraph_index = si.subgraphIndex(subgraphs)
+    pairs = subgraph_index.inducedPairs([emb_train_triples.entity_id_to_label[tp[0]] for tp in X_test], [emb_train_triples.entity_id_to_label[tp[2]] for tp in X_test])
+    hits = np.zeros(len(X_test))
+    for i in np.unique(pairs[0]).tolist():
+        hits[i] = hit(X_test[i])
+    counts, sums = si.groupPairs(pairs, hits, subgraph_index.num_subgraphs)
+    return [sums[j]/counts[j] if counts[j] > 2 else -100 for j in range(subgraph_index.num_subgraphs)]
+
 def baselineLP_relation(model, subgraphs, emb_train_triples, X_test, all_triples):
     start_time_clf_training = timeit.default_timer()
-    LP_score_list = []
-    for subgraph in subgraphs:
-        sum = 0
-        counter = 0
-        for tp in X_test:
-            if (emb_train_triples.entity_id_to_label[tp[0]] in subgraph) and (emb_train_triples.entity_id_to_label[tp[2]] in subgraph):
-                tmp_scores = dict()
-                for relation in range(emb_train_triples.num_relations):
-                    tup = (tp[0],relation,tp[2])
-                    if tup in all_triples and relation != tp[1]:
-                        continue
-                    ten = torch.tensor([[tp[0],relation,tp[2]]])
-                    score = model.score_hrt(ten)
-                    score = score.detach().numpy()[0][0]
-                    tmp_scores[relation] = score
-                id = max(tmp_scores, key=tmp_scores.get)
-                if id == tp[1]:
-                    sum += 1
-                else:
-                    sum += 0
-                counter += 1
-        if counter > 2:
-            LP_score_list.append(sum/counter)
-        else:
-            LP_score_list.append(-100)
+    def hit(tp):
+        relations = torch.unique(torch.cat((all_triples.negativeRelations(tp[0], tp[2]), torch.tensor([tp[1]]))))
+        ten = torch.stack((torch.full_like(relations, tp[0]), relations, torch.full_like(relations, tp[2])), dim=1)
+        score = model.score_hrt(ten).detach().flatten()
+        return relations[torch.argmax(score)].item() == tp[1]
+    LP_score_list = baselineLPHits(subgraphs, emb_train_triples, X_test, hit)
     return LP_score_list, start_time_clf_training, start_time_clf_training, start_time_clf_training, start_time_clf_training
 
 def baselineLP_tail(model, subgraphs, emb_train_triples, X_test, all_triples):
     start_time_clf_training = timeit.default_timer()
-    LP_score_list = []
-    for subgraph in subgraphs:
-        sum = 0
-        counter = 0
-        for tp in X_test:
-            if (emb_train_triples.entity_id_to_label[tp[0]] in subgraph) and (emb_train_triples.entity_id_to_label[tp[2]] in subgraph):
-                tmp_scores = dict()
-                for tail in range(emb_train_triples.num_entities):
-                    tup = (tp[0],tp[1],tail)
-                    if tup in all_triples and tail != tp[2]:
-                        continue
-                    ten = torch.tensor([[tp[0],tp[1],tail]])
-                    score = model.score_hrt(ten)
-                    score = score.detach().numpy()[0][0]
-                    tmp_scores[tail] = score
-                id = max(tmp_scores, key=tmp_scores.get)
-                if id == tp[2]:
-                    sum += 1
-                else:
-                    sum += 0
-                counter += 1
-        if counter > 2:
-            LP_score_list.append(sum/counter)
-        else:
-            LP_score_list.append(-100)
+    def hit(tp):
+        tails = torch.unique(torch.cat((all_triples.negativeTails(tp[0], tp[1]), torch.tensor([tp[2]]))))
+        ten = torch.stack((torch.full_like(tails, tp[0]), torch.full_like(tails, tp[1]), tails), dim=1)
+        score = model.score_hrt(ten).detach().flatten()
+        return tails[torch.argmax(score)].item() == tp[2]
+    LP_score_list = baselineLPHits(subgraphs, emb_train_triples, X_test, hit)
     return LP_score_list, start_time_clf_training, start_time_clf_training, start_time_clf_training, start_time_clf_training
\ No newline at end of file
@@ -6,10 +6,18 @@ import networkx as nx
 import csv
 import timeit
 import itertools
+import math
+from collections import OrderedDict
 
 import embedding as emb
 import datahandler as dh
 import classifier as cla
+import tripleindex as ti
+import edgestore as es
+import graphstats as gs
+import ranking
+import subgraphindex as si
+import foldexecutor as fe
 
 from pykeen.models import TransE
 from pykeen.models import ERModel
@@ -24,6 +32,14 @@ import numpy as np
 
 import os
 
+def resolveDevice(device=None) -> str:
+    '''
+    pick the device for scoring and sampling, cuda if available and nothing else was asked for, otherwise cpu
+    '''
+    if device is None or device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
 def makeTCPart(LP_triples_pos, LP_triples_neg, entity2embedding, relation2embedding, subgraphs, emb_train_triples, classifier):
     '''
     function to access and run triple classification with trained classifiers
@@ -40,66 +56,23 @@ def naiveTripleCLassification(LP_triples_pos, LP_triples_neg, entity_to_id_map,
     '''
     LP_test_score = []
     X_train_pos, X_test_pos, y_train_pos, y_test_pos, X_train_neg, X_test_neg, y_train_neg, y_test_neg = cla.prepareTrainTestDataSplit(LP_triples_pos, LP_triples_neg, emb_train_triples, entity_to_id_map, relation_to_id_map)
-    first = True
-    for i in range(len(X_train_pos)):
-        if first:
-            first = False
-            rslt_torch_pos = X_train_pos[i][0]
-            rslt_torch_pos = rslt_torch_pos.resize_(1,3)
-            
+    comp_score_pos = model.score_hrt(X_train_pos)
+    comp_score_neg = model.score_hrt(X_train_neg)
+
+    thresh = cla.bestThreshold(comp_score_pos, comp_score_neg)
+
+    # every test triple is classified once, the results are grouped per subgraph touched by its head or tail
+    subgraph_index = si.subgraphIndex(subgraphs)
+    wrong_pos = (model.score_hrt(X_test_pos) < thresh).flatten().cpu().numpy()
+    wrong_neg = (model.score_hrt(X_test_neg) > thresh).flatten().cpu().numpy()
+    count_pos, false_pos = si.groupPairs(subgraph_index.incidentPairs([emb_train_triples.entity_id_to_label[h] for h in X_test_pos[:,0].tolist()], [emb_train_triples.entity_id_to_label[t] for t in X_test_pos[:,2].tolist()]), wrong_pos, subgraph_index.num_subgraphs)
+    count_neg, false_neg = si.groupPairs(subgraph_index.incidentPairs([emb_train_triples.entity_id_to_label[h] for h in X_test_neg[:,0].tolist()], [emb_train_triples.entity_id_to_label[t] for t in X_test_neg[:,2].tolist()]), wrong_neg, subgraph_index.num_subgraphs)
+    for count, false in zip((count_pos + count_neg).tolist(), (false_pos + false_neg).tolist()):
+        if count == 0:
+            # no test triple touches the subgraph, not measured
+            LP_test_score.append(-100)
         else:
-            rslt_torch_pos = torch.cat((rslt_torch_pos,  X_train_pos[i][0].resize_(1,3)))
-    first = True
-    for i in range(len(X_train_neg)):
-        if first:
-            first = False
-            rslt_torch_neg = X_train_neg[i][0]
-            rslt_torch_neg = rslt_torch_neg.resize_(1,3)
-            
-        else:
-            rslt_torch_neg = torch.cat((rslt_torch_neg,  X_train_neg[i][0].resize_(1,3)))
-    comp_score_pos = model.score_hrt(rslt_torch_pos)
-    comp_score_neg = model.score_hrt(rslt_torch_neg)
-
-    first = True
-    for i in range(torch.sum(comp_score_neg > torch.min(comp_score_pos)).cpu().detach().numpy()):
-        k = torch.topk(comp_score_neg, i+1, dim=-2)
-        pos_low = torch.sum(comp_score_pos < k.values[i]).cpu().detach().numpy()
-        neg_hig = torch.sum(comp_score_neg > k.values[i]).cpu().detach().numpy()
-        if first:
-            min_false = pos_low + neg_hig
-            first = False
-        if min_false > neg_hig + pos_low:
-            thresh = k.values[i]
-            min_false = neg_hig + pos_low
-    first = True
-    for subgraph in subgraphs:
-        for tp in X_test_pos:
-            if ((emb_train_triples.entity_id_to_label[tp[0][0].item()] in subgraph) or (emb_train_triples.entity_id_to_label[tp[0][2].item()] in subgraph)):
-                if first:
-                    first = False
-                    rslt_torch_pos = tp[0]
-                    rslt_torch_pos = rslt_torch_pos.resize_(1,3)
-                else:
-                    rslt_torch_pos = torch.cat((rslt_torch_pos, tp[0].resize_(1,3)))
-        first = True
-        for tp in X_test_neg:
-            if ((emb_train_triples.entity_id_to_label[tp[0][0].item()] in subgraph) or (emb_train_triples.entity_id_to_label[tp[0][2].item()] in subgraph)):
-                if first:
-                    first = False
-                    rslt_torch_neg = tp[0]
-                    rslt_torch_neg = rslt_torch_neg.resize_(1,3)
-                else:
-                    rslt_torch_neg = torch.cat((rslt_torch_neg, tp[0].resize_(1,3)))
-    
-        
-        comp_score_pos = model.score_hrt(rslt_torch_pos)
-        comp_score_neg = model.score_hrt(rslt_torch_neg)
-            
-        pos_low = torch.sum(comp_score_pos < thresh).cpu().detach().numpy()
-        neg_hig = torch.sum(comp_score_neg > thresh).cpu().detach().numpy()
-
-        LP_test_score.append((rslt_torch_pos.shape[0]+rslt_torch_neg.shape[0]-(pos_low+neg_hig))/(rslt_torch_pos.shape[0]+rslt_torch_neg.shape[0]))
+            LP_test_score.append((count-false)/count)
     return LP_test_score
 
 
@@ -118,12 +91,6 @@ def grabAllKFold(datasetname: str, n_split: int, embeddingname: str = 'TransE'):
 
     full_graph = TriplesFactory(full_dataset,entity_to_id=entity_to_id_map,relation_to_id=relation_to_id_map)
 
-    # Need to store the ids of all positive triples on GPU
-    global all_triple_id_torch
-    all_triple_id_torch = encode_triples_to_id(full_dataset, full_graph.num_entities, full_graph.num_relations)
-    all_triple_id_torch = all_triple_id_torch.to('cuda')
-    #print("check: ", full_dataset.device, all_triple_id_torch.device)
-
     emb_train_triples = []
     emb_test_triples = []
     LP_triples_pos = []
@@ -142,20 +109,40 @@ def grabAllKFold(datasetname: str, n_split: int, embeddingname: str = 'TransE'):
 
     return all_triples, all_triples_set, entity_to_id_map, relation_to_id_map, emb_train_triples, emb_test_triples, LP_triples_pos, full_graph
 
+# number of processes working on the folds at once for training, ranking and triple classification
+fold_workers = 1
+
+def modelPath(embedding: str, dataset_name: str, n_split: int, i: int) -> str:
+    '''
+    file of the stored model of the i-th fold
+    '''
+    return f"approach/trainedEmbeddings/{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th/trained_model.pkl"
+
+def modelVersion(embedding: str, dataset_name: str, n_split: int, i: int) -> str:
+    '''
+    modification time and size of the stored model of the i-th fold, changes whenever the model is trained again or replaced
+    '''
+    stat = os.stat(modelPath(embedding, dataset_name, n_split, i))
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+def trainFold(embedding: str, dataset_name: str, n_split: int, i: int, emb_train, emb_test):
+    '''
+    train and store the model of the i-th fold, run in a fold worker
+    '''
+    save = f"{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th"
+    emb.trainEmbedding(emb_train, emb_test, random_seed=42, saveModel=True, savename = save, embedd = embedding, dimension = 50, epoch_nmb = 50)
+
 def getOrTrainModels(embedding: str, dataset_name: str, n_split: int, emb_train_triples, emb_test_triples, device):
     '''
     get the already trained model if exists, otherwise train one accordingly
     '''
+    missing = [i for i in range(n_split) if not os.path.isfile(modelPath(embedding, dataset_name, n_split, i))]
+    # the folds are trained independently, the stored models are loaded afterwards
+    fe.runFolds(trainFold, [(embedding, dataset_name, n_split, i, emb_train_triples[i], emb_test_triples[i]) for i in missing], fold_workers)
     models = []
     for i in range(n_split):
-        isFile = os.path.isfile(f"approach/trainedEmbeddings/{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th/trained_model.pkl")
-        if not isFile:
-            save = f"{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th"
-            emb_model, emb_triples_used = emb.trainEmbedding(emb_train_triples[i], emb_test_triples[i], random_seed=42, saveModel=True, savename = save, embedd = embedding, dimension = 50, epoch_nmb = 50)
-            models.append(emb_model)
-        else:
-            save = f"{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th"
-            models.append(emb.loadModel(save,device=device))
+        save = f"{dataset_name}_{embedding}_{n_split}_fold/{dataset_name}_{i}th"
+        models.append(emb.loadModel(save,device=device))
 
     return models
 
@@ -182,29 +169,32 @@ import torch.multiprocessing as mp
 
 parallel_uv = False
 
-def process_edges_partition(edge_partition, heur, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities, num_relations, sample, datasetname, results, device='cuda', perm_entities=None, perm_relations=None, all_triple_id_torch=None):
-    #count = 0
-    sib_sum = 0
-    sib_sum_h = 0
-    sib_sum_t = 0
-    
-    # Process each edge in the partition
-    if heur.__name__ == 'binomial_cuda':
-        for u, v in edge_partition:
-            w, w1, w2 = heur(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities, num_relations, sample, datasetname, device, perm_entities, perm_relations, all_triple_id_torch)
-            #count += 1
-            sib_sum += w
-            sib_sum_h += w1
-            sib_sum_t += w2
-    else:
-        for u, v in edge_partition:
-            w, w1, w2 = heur(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities, num_relations, sample, datasetname)
-            #count += 1
-            sib_sum += w
-            sib_sum_h += w1
-            sib_sum_t += w2
-    print(f"Success: {os.getpid()}")
-    results.append((sib_sum, sib_sum_h, sib_sum_t))
+# number of worker processes if parallel_uv is set
+num_processors = 10
+# state of a worker process, set once by initEdgeWorker
+worker_state = None
+
+def initEdgeWorker(heur, M, models, entity_to_id_map, relation_to_id_map, triple_index_handle, full_graph, sample, datasetname, device='cpu', perm_entities=None, perm_relations=None, batch_size=None):
+    '''
+    load models once per worker process and attach to the triple index in shared memory
+    spawned workers import this module again, so the candidate batch size of the main process is set here
+    '''
+    global worker_state
+    global candidate_batch_size
+    candidate_batch_size = batch_size
+    all_triples_set = ti.TripleIndex.attach(triple_index_handle)
+    worker_state = (heur, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname, device, perm_entities, perm_relations)
+
+def process_edges_partition(edge_partition):
+    '''
+    ReliK scores of one chunk of edges, computed in a worker process
+    '''
+    heur, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname, device, perm_entities, perm_relations = worker_state
+    scores = []
+    # Process the edges of the partition in batches
+    for start in range(0, len(edge_partition), edge_batch_size):
+        scores += scoreEdgeBatch(heur, edge_partition[start:start+edge_batch_size], M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname, device, perm_entities, perm_relations)
+    return edge_partition, scores
 
 getkHopneighbors_time = 0.0
 sample_time = 0.0
@@ -213,10 +203,15 @@ model_loop_time = 0.0
 sample_first_while_time = 0.0
 sample_second_while_time = 0.0
 
-def DoGlobalReliKScore(embedding, datasetname, n_split, size_subgraph, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, heur):
+# edges kept in memory by the edge score store, with a spill path the rest is moved to disk
+edge_score_memory_limit = 2**22
+edge_score_spill_path = None
+
+def DoGlobalReliKScore(embedding, datasetname, n_split, size_subgraph, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, heur, device=None):
     '''
     compute the ReliK score on all subgraphs according to chosen heuristic
     '''
+    device = resolveDevice(device)
     global getkHopneighbors_time, sample_time, entity_relation_loop_time, model_loop_time, sample_first_while_time, sample_second_while_time
     getkHopneighbors_time = 0.0
     sample_time = 0.0
@@ -224,6 +219,7 @@ def DoGlobalReliKScore(embedding, datasetname, n_split, size_subgraph, models, e
     model_loop_time = 0.0
     sample_first_while_time = 0.0
     sample_second_while_time = 0.0
+    clearNegScoreCache()
     df = pd.DataFrame(full_graph.triples, columns=['subject', 'predicate', 'object'])
     M = nx.MultiDiGraph()
 
@@ -237,142 +233,69 @@ def DoGlobalReliKScore(embedding, datasetname, n_split, size_subgraph, models, e
 
     for t in df.values:
         M.add_edge(t[0], t[2], label = t[1])
-
+    # DiGraph projection of M, built once for all subgraphs
+    projection = dh.EdgeProjection.fromGraph(M)
 
     model_ReliK_score = []
     model_ReliK_score_h = []
     model_ReliK_score_t = []
     tracker = 0
 
-    num_entities_par = full_graph.num_entities
-    num_relations_par = full_graph.num_relations
     #print(full_graph.num_triples, full_graph.num_entities)
+    # subgraphs overlap, every distinct edge is scored once and the subgraph means are taken from the store
+    store = es.EdgeScoreStore(memory_limit=edge_score_memory_limit, spill_path=edge_score_spill_path)
+    subgraph_edges = [projection.induced(subgraph) for subgraph in subgraphs]
+    edges = store.missing(itertools.chain.from_iterable(subgraph_edges))
+    print(f'scoring {len(edges)} distinct edges of {sum(len(e) for e in subgraph_edges)} subgraph edges')
+
+    perm_entities, perm_relations = None, None
+    if heur.__name__ == 'binomial_cuda' or parallel_uv is True:
+        perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations, device=device)
+    start_uv = timeit.default_timer()
     ### HERE!!!
     if parallel_uv is False:
-        if heur.__name__ == 'binomial_cuda':
-            perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations)
-            for subgraph in subgraphs:
-                count = 0
-                sib_sum = 0
-                sib_sum_h = 0
-                sib_sum_t = 0
-                start_uv = timeit.default_timer()
-                for u,v in nx.DiGraph(M).subgraph(subgraph).edges():
-                    w, w1, w2 = heur(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities_par, num_relations_par, sample, datasetname, 'cuda', perm_entities, perm_relations, all_triple_id_torch)
-                    count += 1
-                    sib_sum += w
-                    sib_sum_h += w1
-                    sib_sum_t += w2
-                end_uv = timeit.default_timer()
-                print(f'have done subgraph: {id(subgraph)} in {end_uv - start_uv}, with {count} edges')
-
-                sib_sum = sib_sum/count
-                sib_sum_h = sib_sum_h/count
-                sib_sum_t = sib_sum_t/count
-                model_ReliK_score.append(sib_sum)
-                model_ReliK_score_h.append(sib_sum_h)
-                model_ReliK_score_t.append(sib_sum_t)
-                tracker += 1
-                if tracker % 10 == 0:
-                    print(f'have done {tracker} of {len(subgraphs)} in {embedding}')
         #start_time_enum_subgraph = timeit.default_timer()
-        else:
-            for subgraph in subgraphs:
-                count = 0
-                sib_sum = 0
-                sib_sum_h = 0
-                sib_sum_t = 0
-                start_uv = timeit.default_timer()
-                for u,v in nx.DiGraph(M).subgraph(subgraph).edges():
-                    w, w1, w2 = heur(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities_par, num_relations_par, sample, datasetname)
-                    count += 1
-                    sib_sum += w
-                    sib_sum_h += w1
-                    sib_sum_t += w2
-                end_uv = timeit.default_timer()
-                print(f'have done subgraph: {id(subgraph)} in {end_uv - start_uv}, with {count} edges')
-
-                sib_sum = sib_sum/count
-                sib_sum_h = sib_sum_h/count
-                sib_sum_t = sib_sum_t/count
-                model_ReliK_score.append(sib_sum)
-                model_ReliK_score_h.append(sib_sum_h)
-                model_ReliK_score_t.append(sib_sum_t)
-                tracker += 1
-                if tracker % 10 == 0:
-                    print(f'have done {tracker} of {len(subgraphs)} in {embedding}')
-        print(f"Total time for dh.getkHopneighbors: {getkHopneighbors_time} seconds")
-        print(f"Total time for sampling: {sample_time} seconds")
-        print(f"Total time for model loop: {model_loop_time} seconds")
-        print(f"Total time for sample first while loop: {sample_first_while_time} seconds")
-        print(f"Total time for sample second while loop: {sample_second_while_time} seconds")
+        for start in range(0, len(edges), edge_batch_size):
+            edge_batch = edges[start:start+edge_batch_size]
+            for edge, scores in zip(edge_batch, scoreEdgeBatch(heur, edge_batch, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname, device, perm_entities, perm_relations)):
+                store[edge] = scores
         #end_time_enum_subgraph = timeit.default_timer()
         #print(f'Enum subgraph time: {end_time_enum_subgraph - start_time_enum_subgraph}')
     else: # parallel_uv = True
-        # Try to use multi processors
+        # One pool for all edges, every worker gets models and triple index only once
         mp.set_start_method('spawn', force=True)
-        perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations)
-        # Use Manager to create shared lists
-        """
-        manager = mp.Manager()
-        perm_entities = manager.list(perm_entities)
-        perm_relations = manager.list(perm_relations)
-        """
-
-        for subgraph in subgraphs:
-            count = 0
-            sib_sum = 0
-            sib_sum_h = 0
-            sib_sum_t = 0
-            start_uv = timeit.default_timer()
-            
-            edges = list(nx.DiGraph(M).subgraph(subgraph).edges())
-            count = len(edges)
-            num_processors = 10
-
-            chunk_size = len(edges) // num_processors
-
-            edge_chunks = [edges[i * chunk_size:(i + 1) * chunk_size] if i < num_processors - 1 else edges[i * chunk_size:] for i in range(num_processors)]
-
-            manager = mp.Manager()
-            results = manager.list()
-
-            processes = []
-            if heur.__name__ == 'binomial_cuda':
-                for i,edge_chunk in enumerate(edge_chunks):
-                    p = mp.Process(target=process_edges_partition, args=(edge_chunk, heur, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities_par, num_relations_par, sample, datasetname, results, 'cuda', perm_entities, perm_relations, all_triple_id_torch))
-                    p.start()
-                    processes.append(p)
-            else:
-                for i,edge_chunk in enumerate(edge_chunks):
-                    p = mp.Process(target=process_edges_partition, args=(edge_chunk, heur, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, num_entities_par, num_relations_par, sample, datasetname, results))
-                    p.start()
-                    processes.append(p)
-            for p in processes:
-                p.join()
-            
-            sib_sum = sum([r[0] for r in results])
-            sib_sum_h = sum([r[1] for r in results])
-            sib_sum_t = sum([r[2] for r in results])
-            #print(sib_sum, sib_sum_h, sib_sum_t)
-            
-            end_uv = timeit.default_timer()
-            print(f'have done subgraph: {id(subgraph)} in {end_uv - start_uv}')
-
-            sib_sum = sib_sum/count
-            sib_sum_h = sib_sum_h/count
-            sib_sum_t = sib_sum_t/count
-            model_ReliK_score.append(sib_sum)
-            model_ReliK_score_h.append(sib_sum_h)
-            model_ReliK_score_t.append(sib_sum_t)
-            tracker += 1
-            if tracker % 10 == 0:
-                print(f'have done {tracker} of {len(subgraphs)} in {embedding}')
-        print(f"Total time for dh.getkHopneighbors: {getkHopneighbors_time} seconds")
-        print(f"Total time for sampling: {sample_time} seconds")
-        print(f"Total time for model loop: {model_loop_time} seconds")
-        print(f"Total time for sample first while loop: {sample_first_while_time} seconds")
-        print(f"Total time for sample second while loop: {sample_second_while_time} seconds")
+        tasks = [edges[start:start+edge_batch_size] for start in range(0, len(edges), edge_batch_size)]
+
+        # the workers only read the number of entities and relations, so they get an empty factory instead of a copy of all triples
+        worker_graph = CoreTriplesFactory(torch.empty((0, 3), dtype=torch.long), num_entities=full_graph.num_entities, num_relations=full_graph.num_relations)
+        # the triple index is shared by all workers, the batched heuristics read the u->v relations from it and need no copy of M
+        triple_index_handle = all_triples_set.share()
+        worker_M = None if heur.__name__ in batched_heuristics else M
+        try:
+            with mp.Pool(num_processors, initializer=initEdgeWorker, initargs=(heur, worker_M, models, entity_to_id_map, relation_to_id_map, triple_index_handle, worker_graph, sample, datasetname, device, perm_entities, perm_relations, candidate_batch_size)) as pool:
+                # scores are streamed back as soon as a chunk is done
+                for edge_batch, batch_scores in pool.imap_unordered(process_edges_partition, tasks):
+                    for edge, scores in zip(edge_batch, batch_scores):
+                        store[edge] = scores
+        finally:
+            all_triples_set.unlink()
+    end_uv = timeit.default_timer()
+    print(f'have scored {len(edges)} edges in {end_uv - start_uv}')
+
+    for j, subgraph in enumerate(subgraphs):
+        sib_sum, sib_sum_h, sib_sum_t = store.mean(subgraph_edges[j])
+        model_ReliK_score.append(sib_sum)
+        model_ReliK_score_h.append(sib_sum_h)
+        model_ReliK_score_t.append(sib_sum_t)
+        tracker += 1
+        if tracker % 10 == 0:
+            print(f'have done {tracker} of {len(subgraphs)} in {embedding}')
+    store.close()
+    print(f"Total time for edge label lookup: {getkHopneighbors_time} seconds")
+    print(f"Total time for sampling: {sample_time} seconds")
+    print(f"Total time for model loop: {model_loop_time} seconds")
+    print(f"Total time for sample first while loop: {sample_first_while_time} seconds")
+    print(f"Total time for sample second while loop: {sample_second_while_time} seconds")
 
     path = f"approach/scoreData/{datasetname}_{n_split}/{embedding}/ReliK_score_subgraphs_{size_subgraph}.csv"
     if parallel_uv is True:
@@ -408,6 +331,13 @@ def randomsample(embedding, datasetname, n_split, size_subgraph, models, entity_
     M.remove_nodes_from([n for n in M if n not in set(list(M.neighbors(rand[0]))+list(M.neighbors(rand[1])))])
     print(len(M.nodes))
     
+def classifyFold(LP_triples_pos, LP_triples_neg, entity_to_id_map, relation_to_id_map, subgraphs, emb_train, model):
+    '''
+    triple classification scores of one fold on all subgraphs, run in a fold worker
+    '''
+    #LP_test_score = makeTCPart(LP_triples_pos,  LP_triples_neg, entity2embedding, relation2embedding, subgraphs, emb_train, classifier)
+    return naiveTripleCLassification(LP_triples_pos,  LP_triples_neg, entity_to_id_map, relation_to_id_map, subgraphs, emb_train, model)
+
 def classifierExp(embedding, datasetname, size_subgraph, LP_triples_pos,  LP_triples_neg, entity2embedding, relation2embedding, emb_train, n_split, models, entity_to_id_map, relation_to_id_map, classifier):
     '''
     running the classification experiment parts on the subgraphs
@@ -421,13 +351,10 @@ def classifierExp(embedding, datasetname, size_subgraph, LP_triples_pos,  LP_tri
             for ele in row:
                 subgraph.add(ele)
             subgraphs.append(subgraph)
+    # one index of the subgraphs for all folds
+    subgraph_index = si.SubgraphIndex(subgraphs)
     
-    score_cla = []
-    for i in range(n_split):
-        #LP_test_score = makeTCPart(LP_triples_pos[i],  LP_triples_neg[i], entity2embedding, relation2embedding, subgraphs, emb_train[i], classifier)
-        #score_cla.append(LP_test_score)
-        LP_test_score = naiveTripleCLassification(LP_triples_pos[i],  LP_triples_neg[i], entity_to_id_map, relation_to_id_map, subgraphs, emb_train[i], models[i])
-        score_cla.append(LP_test_score)
+    score_cla = fe.runFolds(classifyFold, [(LP_triples_pos[i],  LP_triples_neg[i], entity_to_id_map, relation_to_id_map, subgraph_index, emb_train[i], models[i]) for i in range(n_split)], fold_workers)
 
     fin_score_cla = []
     for i in range(len(score_cla[0])):
@@ -452,6 +379,51 @@ def classifierExp(embedding, datasetname, size_subgraph, LP_triples_pos,  LP_tri
         writer.writerow(data)
     c.close()
 
+def rankFold(model, LP_triples_pos, triple_index_handle):
+    '''
+    filtered tail, relation and head ranks of the test triples of one fold, run in a fold worker
+    '''
+    all_triples_set = ti.TripleIndex.attach(triple_index_handle) if isinstance(triple_index_handle, dict) else triple_index_handle
+    return (ranking.filteredRanks(model, LP_triples_pos, all_triples_set, 'tail').numpy(),
+            ranking.filteredRanks(model, LP_triples_pos, all_triples_set, 'relation').numpy(),
+            ranking.filteredRanks(model, LP_triples_pos, all_triples_set, 'head').numpy())
+
+def getOrComputeRanks(embedding, datasetname, n_split, models, LP_triples_pos, all_triples_set):
+    '''
+    filtered tail, relation and head ranks of every test triple per fold, computed once and stored, otherwise loaded
+    stored ranks are only used if they belong to the same test triples and the same version of the fold's model file
+    '''
+    paths = [f"approach/scoreData/{datasetname}_{n_split}/{embedding}/ranks_{i}th_fold.csv" for i in range(n_split)]
+    versions = [modelVersion(embedding, datasetname, n_split, i) for i in range(n_split)]
+    stored = [pd.read_csv(path, dtype={'model': str}) if os.path.isfile(path) else None for path in paths]
+    missing = [i for i in range(n_split) if stored[i] is None or 'model' not in stored[i] or (stored[i]['model'] != versions[i]).any() or stored[i][['head','relation','tail']].values.tolist() != LP_triples_pos[i]]
+    # the workers share the triple index instead of getting a copy each
+    triple_index_handle = all_triples_set.share() if fold_workers > 1 and len(missing) > 1 else all_triples_set
+    try:
+        fold_ranks = fe.runFolds(rankFold, [(models[i], LP_triples_pos[i], triple_index_handle) for i in missing], fold_workers)
+    finally:
+        if isinstance(triple_index_handle, dict):
+            all_triples_set.unlink()
+    for i, (tail_rank, relation_rank, head_rank) in zip(missing, fold_ranks):
+        ranks = pd.DataFrame(LP_triples_pos[i], columns=['head','relation','tail'])
+        ranks['tail rank'] = tail_rank
+        ranks['relation rank'] = relation_rank
+        ranks['head rank'] = head_rank
+        ranks['model'] = versions[i]
+        ranks.to_csv(paths[i], index=False)
+        stored[i] = ranks
+    tail_ranks = [torch.from_numpy(ranks['tail rank'].values) for ranks in stored]
+    relation_ranks = [torch.from_numpy(ranks['relation rank'].values) for ranks in stored]
+    head_ranks = [torch.from_numpy(ranks['head rank'].values) for ranks in stored]
+    return tail_ranks, relation_ranks, head_ranks
+
+def predictionSubgraphPairs(subgraphs, emb_train, LP_triples_pos, n_split):
+    '''
+    for every fold the (test triple, subgraph) pairs with head and tail of the test triple in the subgraph
+    '''
+    subgraph_index = si.SubgraphIndex(subgraphs)
+    return [subgraph_index.inducedPairs([emb_train[i].entity_id_to_label[tp[0]] for tp in LP_triples_pos[i]], [emb_train[i].entity_id_to_label[tp[2]] for tp in LP_triples_pos[i]]) for i in range(n_split)]
+
 def prediction(embedding, datasetname, size_subgraph, emb_train, all_triples_set, n_split):
     '''
     doing the tail and relation prediction experiments on the subgraphs
@@ -464,106 +436,19 @@ def prediction(embedding, datasetname, size_subgraph, emb_train, all_triples_set
     if len(subgraphs) > n_subgraphs:
         subgraphs = subgraphs[:n_subgraphs]
 
-    fin_score_tail_at1 = []
-    fin_score_tail_at5 = []
-    fin_score_tail_at10 = []
-    fin_score_tail_atMRR = []
-
-    fin_score_relation_at1 = []
-    fin_score_relation_at5 = []
-    fin_score_relation_at10 = []
-    fin_score_relation_atMRR = []
-    for subgraph in subgraphs:
-        model_relation_sum_at_1 = []
-        model_relation_sum_at_5 = []
-        model_relation_sum_at_10 = []
-        model_relation_sum_for_MRR = []
-
-        model_tail_sum_at_1 = []
-        model_tail_sum_at_5 = []
-        model_tail_sum_at_10 = []
-        model_tail_sum_for_MRR = []
-        for i in range(n_split):
-            relation_sum_at_1 = 0
-            relation_sum_at_5 = 0
-            relation_sum_at_10 = 0
-            relation_sum_for_MRR = 0
-
-            tail_sum_at_1 = 0
-            tail_sum_at_5 = 0
-            tail_sum_at_10 = 0
-            tail_sum_for_MRR = 0
-            counter_of_test_tp = 0
-            for tp in LP_triples_pos[i]:
-                if (emb_train[i].entity_id_to_label[tp[0]] in subgraph) and (emb_train[0].entity_id_to_label[tp[2]] in subgraph):
-                    counter_of_test_tp += 1
-                    ten = torch.tensor([[tp[0],tp[1],tp[2]]])
-                    comp_score = models[i].score_hrt(ten)
-
-                    list_tail = torch.tensor([i for i in range(emb_train[0].num_entities) if (tp[0],tp[1], i) not in all_triples_set ])
-                    list_relation = torch.tensor([i for i in range(emb_train[0].num_relations) if (tp[0],i, tp[2]) not in all_triples_set ])
-
-                    tail_rank = torch.sum(models[i].score_t(ten[0][:2].resize_(1,2), tails=list_tail) > comp_score).cpu().detach().numpy() + 1
-                    relation_rank = torch.sum(models[i].score_r(torch.cat([ten[0][:1], ten[0][1+1:]]).resize_(1,2), relations=list_relation) > comp_score).cpu().detach().numpy() + 1
-                    if relation_rank <= 1:
-                        relation_sum_at_1 += 1
-                        relation_sum_at_5 += 1
-                        relation_sum_at_10 += 1
-                    elif relation_rank <= 5:
-                        relation_sum_at_5 += 1
-                        relation_sum_at_10 += 1
-                    elif relation_rank <= 10:
-                        relation_sum_at_10 += 1
-                    relation_sum_for_MRR += 1/relation_rank
-
-                    if tail_rank <= 1:
-                        tail_sum_at_1 += 1
-                        tail_sum_at_5 += 1
-                        tail_sum_at_10 += 1
-                    elif tail_rank <= 5:
-                        tail_sum_at_5 += 1
-                        tail_sum_at_10 += 1
-                    elif tail_rank <= 10:
-                        tail_sum_at_10 += 1
-                    tail_sum_for_MRR += 1/tail_rank
-            if counter_of_test_tp > 0:
-                model_tail_sum_at_1.append(tail_sum_at_1/counter_of_test_tp)
-                model_tail_sum_at_5.append(tail_sum_at_5/counter_of_test_tp)
-                model_tail_sum_at_10.append(tail_sum_at_10/counter_of_test_tp)
-                model_tail_sum_for_MRR.append(tail_sum_for_MRR/counter_of_test_tp)
-
-                model_relation_sum_at_1.append(relation_sum_at_1/counter_of_test_tp)
-                model_relation_sum_at_5.append(relation_sum_at_5/counter_of_test_tp)
-                model_relation_sum_at_10.append(relation_sum_at_10/counter_of_test_tp)
-                model_relation_sum_for_MRR.append(relation_sum_for_MRR/counter_of_test_tp)
-        if len(model_relation_sum_at_1) > 0:
-            fin_score_tail_at1.append(np.mean(model_tail_sum_at_1))
-            fin_score_tail_at5.append(np.mean(model_tail_sum_at_5))
-            fin_score_tail_at10.append(np.mean(model_tail_sum_at_10))
-            fin_score_tail_atMRR.append(np.mean(model_tail_sum_for_MRR))
-
-            fin_score_relation_at1.append(np.mean(model_relation_sum_at_1))
-            fin_score_relation_at5.append(np.mean(model_relation_sum_at_5))
-            fin_score_relation_at10.append(np.mean(model_relation_sum_at_10))
-            fin_score_relation_atMRR.append(np.mean(model_relation_sum_for_MRR))
-        else:
-            fin_score_tail_at1.append(-100)
-            fin_score_tail_at5.append(-100)
-            fin_score_tail_at10.append(-100)
-            fin_score_tail_atMRR.append(-100)
-
-            fin_score_relation_at1.append(-100)
-            fin_score_relation_at5.append(-100)
-            fin_score_relation_at10.append(-100)
-            fin_score_relation_atMRR.append(-100)
+    # every test triple is ranked once, the subgraph scores are grouped from the ranks of the test triples inside them
+    tail_ranks, relation_ranks, head_ranks = getOrComputeRanks(embedding, datasetname, n_split, models, LP_triples_pos, all_triples_set)
+    fold_pairs = predictionSubgraphPairs(subgraphs, emb_train, LP_triples_pos, n_split)
+    tail_scores = ranking.subgraphHitsAndMRR(tail_ranks, fold_pairs, len(subgraphs))
+    relation_scores = ranking.subgraphHitsAndMRR(relation_ranks, fold_pairs, len(subgraphs))
 
     path = f"approach/scoreData/{datasetname}_{n_split}/{embedding}/prediction_score_subgraphs_{size_subgraph}.csv"
     c = open(f'{path}', "w")
     writer = csv.writer(c)
     data = ['subgraph','Tail Hit @ 1','Tail Hit @ 5','Tail Hit @ 10','Tail MRR','Relation Hit @ 1','Relation Hit @ 5','Relation Hit @ 10','Relation MRR']
     writer.writerow(data)
-    for j in range(len(fin_score_tail_at1)):
-        data = [j, fin_score_tail_at1[j], fin_score_tail_at5[j], fin_score_tail_at10[j], fin_score_tail_atMRR[j], fin_score_relation_at1[j], fin_score_relation_at5[j], fin_score_relation_at10[j], fin_score_relation_atMRR[j]]
+    for j in range(len(subgraphs)):
+        data = [j, *tail_scores[:, j].tolist(), *relation_scores[:, j].tolist()]
         writer.writerow(data)
     c.close()
 
@@ -579,64 +464,18 @@ def prediction_head(embedding, datasetname, size_subgraph, emb_train, all_triple
     if len(subgraphs) > n_subgraphs:
         subgraphs = subgraphs[:n_subgraphs]
 
-    fin_score_head_at1 = []
-    fin_score_head_at5 = []
-    fin_score_head_at10 = []
-    fin_score_head_atMRR = []
-
-    for subgraph in subgraphs:
-        model_head_sum_at_1 = []
-        model_head_sum_at_5 = []
-        model_head_sum_at_10 = []
-        model_head_sum_for_MRR = []
-        for i in range(n_split):
-            head_sum_at_1 = 0
-            head_sum_at_5 = 0
-            head_sum_at_10 = 0
-            head_sum_for_MRR = 0
-            counter_of_test_tp = 0
-            for tp in LP_triples_pos[i]:
-                if (emb_train[i].entity_id_to_label[tp[0]] in subgraph) and (emb_train[0].entity_id_to_label[tp[2]] in subgraph):
-                    counter_of_test_tp += 1
-                    ten = torch.tensor([[tp[0],tp[1],tp[2]]])
-                    comp_score = models[i].score_hrt(ten)
-
-                    list_head = torch.tensor([i for i in range(emb_train[0].num_entities) if (i,tp[1], tp[2]) not in all_triples_set ])
-                    head_rank = torch.sum(models[i].score_h(ten[0][1:].resize_(1,2), heads=list_head) > comp_score).cpu().detach().numpy() + 1
-
-                    if head_rank <= 1:
-                        head_sum_at_1 += 1
-                        head_sum_at_5 += 1
-                        head_sum_at_10 += 1
-                    elif head_rank <= 5:
-                        head_sum_at_5 += 1
-                        head_sum_at_10 += 1
-                    elif head_rank <= 10:
-                        head_sum_at_10 += 1
-                    head_sum_for_MRR += 1/head_rank
-            if counter_of_test_tp > 0:
-                model_head_sum_at_1.append(head_sum_at_1/counter_of_test_tp)
-                model_head_sum_at_5.append(head_sum_at_5/counter_of_test_tp)
-                model_head_sum_at_10.append(head_sum_at_10/counter_of_test_tp)
-                model_head_sum_for_MRR.append(head_sum_for_MRR/counter_of_test_tp)
-        if len(model_head_sum_at_1) > 0:
-            fin_score_head_at1.append(np.mean(model_head_sum_at_1))
-            fin_score_head_at5.append(np.mean(model_head_sum_at_5))
-            fin_score_head_at10.append(np.mean(model_head_sum_at_10))
-            fin_score_head_atMRR.append(np.mean(model_head_sum_for_MRR))
-        else:
-            fin_score_head_at1.append(-100)
-            fin_score_head_at5.append(-100)
-            fin_score_head_at10.append(-100)
-            fin_score_head_atMRR.append(-100)
+    # every test triple is ranked once, the subgraph scores are grouped from the ranks of the test triples inside them
+    tail_ranks, relation_ranks, head_ranks = getOrComputeRanks(embedding, datasetname, n_split, models, LP_triples_pos, all_triples_set)
+    fold_pairs = predictionSubgraphPairs(subgraphs, emb_train, LP_triples_pos, n_split)
+    head_scores = ranking.subgraphHitsAndMRR(head_ranks, fold_pairs, len(subgraphs))
 
     path = f"approach/scoreData/{datasetname}_{n_split}/{embedding}/prediction_head_score_subgraphs_{size_subgraph}.csv"
     c = open(f'{path}', "w")
     writer = csv.writer(c)
     data = ['subgraph','head Hit @ 1','head Hit @ 5','head Hit @ 10','head MRR']
     writer.writerow(data)
-    for j in range(len(fin_score_head_at1)):
-        data = [j, fin_score_head_at1[j], fin_score_head_at5[j], fin_score_head_at10[j], fin_score_head_atMRR[j]]
+    for j in range(len(subgraphs)):
+        data = [j, *head_scores[:, j].tolist()]
         writer.writerow(data)
     c.close()
 
@@ -701,68 +540,211 @@ def findingRankNegHead(orderedList, key, all_triples_set, fix):
     '''
     Helper function to find rank of triple with fixed head
     '''
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (fix,ele[0],ele[1])
-        if tup in all_triples_set:
-            continue
-        counter += 1
-    return None
+    return dh.findingRankNegHead(orderedList, key, all_triples_set, fix)
 
 def findingRankNegTail(orderedList, key, all_triples_set, fix):
     '''
     Helper function to find rank of triple with fixed tail
     '''
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (ele[0],ele[1],fix)
-        if tup in all_triples_set:
-            continue
-        counter += 1
-    return None
+    return dh.findingRankNegTail(orderedList, key, all_triples_set, fix)
 
 def findingRankNegHead_Yago(orderedList, key, all_triples_set, fix, map, map_r):
     '''
     Helper function to find rank of triple with fixed head on the yago2 dataset
     '''
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (map[fix],map_r[ele[0]],map[ele[1]])
-        if tup in all_triples_set:
-            continue
-        counter += 1
-    return None
+    ordered = [ele[:2] for ele in orderedList]
+    found = [i for i, ele in enumerate(ordered) if key[0] == ele[0] and key[1] == ele[1]]
+    if len(found) == 0:
+        return None
+    candidates = [(map[fix],map_r[ele[0]],map[ele[1]]) for ele in ordered[:found[0]]]
+    return found[0] - int(np.sum(all_triples_set.contains(candidates))) + 1
 
 def findingRankNegTail_Yago(orderedList, key, all_triples_set, fix, map, map_r):
     '''
     Helper function to find rank of triple with fixed tail on the yago2 dataset
     '''
-    counter = 1
-    for ele in orderedList:
-        if key[0] == ele[0] and key[1] == ele[1]:
-            return counter
-        tup = (map[ele[0]],map_r[ele[1]],map[fix])
-        if tup in all_triples_set:
+    ordered = [ele[:2] for ele in orderedList]
+    found = [i for i, ele in enumerate(ordered) if key[0] == ele[0] and key[1] == ele[1]]
+    if len(found) == 0:
+        return None
+    candidates = [(map[ele[0]],map_r[ele[1]],map[fix]) for ele in ordered[:found[0]]]
+    return found[0] - int(np.sum(all_triples_set.contains(candidates))) + 1
+
+# sorted scores of the negatives per (model, entity, side), shared by all edges of a run
+neg_score_cache = OrderedDict()
+neg_score_cache_size = 0
+# upper bound on the number of cached scores, least recently used entities are dropped first
+neg_score_cache_limit = 2**28
+
+def clearNegScoreCache():
+    '''
+    drop all cached negative scores and the stacked models, needs to be done whenever models, known triples or sampling change
+    '''
+    global neg_score_cache_size
+    global model_ensemble
+    neg_score_cache.clear()
+    neg_score_cache_size = 0
+    model_ensemble = None
+
+def iterSortedNegScores(model, entities: list[int], side: str, negative_keys, num_entities: int, num_relations: int, tag: str='exact'):
+    '''
+    sorted scores of the negatives of entities as head or tail, scored only once per (model, entity, side)
+    with a ModelEnsemble the scores of all its models are sorted per model, as (K,N) tensor
+    negative_keys(entity) gives the negatives as keys relation*num_entities+other and is only called for entities that are not cached yet
+    the entities are scored one at a time and the cache is trimmed before each is added, so only one entity is held besides the cache
+    '''
+    global neg_score_cache_size
+    for entity in entities:
+        key = (tag, id(model), entity, side)
+        if key in neg_score_cache:
+            neg_score_cache.move_to_end(key)
+            yield neg_score_cache[key]
             continue
-        counter += 1
-    return None
+        entity_keys = negative_keys(entity)
+        if scoreOnGrid([entity_keys], num_entities, num_relations)[0]:
+            entity_scores = scoreNegativeKeys(model, entity, side, entity_keys, num_entities, num_relations)
+        else:
+            entity_scores = scoreCandidates(model, decode_id_to_tensor(entity_keys, entity, num_entities, num_relations, side))
+        del entity_keys
+        entity_scores = torch.sort(entity_scores)[0]
+        while len(neg_score_cache) > 0 and neg_score_cache_size + entity_scores.numel() > neg_score_cache_limit:
+            _, dropped = neg_score_cache.popitem(last=False)
+            neg_score_cache_size -= dropped.numel()
+        neg_score_cache[key] = entity_scores
+        neg_score_cache_size += entity_scores.numel()
+        yield entity_scores
+        del entity_scores
+
+def getSortedNegScores(model, entities: list[int], side: str, negative_keys, num_entities: int, num_relations: int, tag: str='exact') -> list[torch.Tensor]:
+    '''
+    list of the sorted negative scores of iterSortedNegScores, holds the scores of all entities at once
+    '''
+    return list(iterSortedNegScores(model, entities, side, negative_keys, num_entities, num_relations, tag))
+
+def countHigher(sorted_scores: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+    '''
+    number of sorted_scores strictly higher than each of the given scores, found with a binary search
+    (K,N) sorted scores of a ModelEnsemble are compared row by row with (K,M) scores
+    '''
+    return sorted_scores.shape[-1] - torch.searchsorted(sorted_scores, scores.to(sorted_scores.device).contiguous(), right=True)
+
+# number of candidate triples going through a model at once, None scores all candidates together
+candidate_batch_size = None
+
+def scoreCandidates(model, candidates: torch.Tensor) -> torch.Tensor:
+    '''
+    scores of all candidate triples, computed in blocks of candidate_batch_size
+    '''
+    batch = candidate_batch_size or max(len(candidates), 1)
+    scores = [model.score_hrt(candidates[start:start+batch]).detach().squeeze(-1) for start in range(0, max(len(candidates), 1), batch)]
+    return torch.cat(scores, dim=-1)
+
+def countHigherStreamed(model, candidates: torch.Tensor, scores: torch.Tensor, candidate_seg: torch.Tensor=None, score_seg: torch.Tensor=None, num_segments: int=1) -> torch.Tensor:
+    '''
+    number of candidates scoring strictly higher than each of the given scores, with segments only those of the same segment
+    the candidates go through the model in blocks of candidate_batch_size and only the running counts are kept
+    '''
+    batch = candidate_batch_size or max(len(candidates), 1)
+    counts = torch.zeros(scores.shape, dtype=torch.long, device=scores.device)
+    for start in range(0, len(candidates), batch):
+        block = model.score_hrt(candidates[start:start+batch].to(scores.device)).detach().squeeze(-1)
+        if candidate_seg is None:
+            counts += countHigher(torch.sort(block)[0], scores)
+        else:
+            counts += countHigherSegments(block, candidate_seg[start:start+batch], scores, score_seg, num_segments)
+    return counts
+
+# score the negatives of an entity with the 1-N interactions score_t / score_h of the models instead of score_hrt
+one_to_n_scoring = True
+# the 1-N interactions score all num_entities*num_relations candidates of an entity, so they are only used
+# if the negatives cover at least this fraction of them, smaller (sampled) sets are scored with score_hrt
+one_to_n_min_coverage = 0.25
+
+def scoreOnGrid(keys: list[torch.Tensor], num_entities: int, num_relations: int) -> list[bool]:
+    '''
+    for the negative keys of every entity, whether they are scored with the 1-N interactions
+    '''
+    return [one_to_n_scoring and len(entity_keys) >= one_to_n_min_coverage * num_entities * num_relations for entity_keys in keys]
+
+def iterNegativeKeyBlocks(model, entity: int, side: str, keys: torch.Tensor, num_entities: int, num_relations: int):
+    '''
+    scores of the negatives relation*num_entities+other of a fixed head (side='head') or tail (side='tail'), one block at a time
+    every block scores candidate_batch_size candidates (whole relations) against all entities with score_t (score_h)
+    and yields the scores of the keys inside it, in order of the keys
+    '''
+    relations_per_block = max((candidate_batch_size or num_entities*num_relations) // num_entities, 1)
+    keys = torch.sort(keys.to(model.device))[0]
+    for start in range(0, num_relations, relations_per_block):
+        stop = min(start + relations_per_block, num_relations)
+        low, high = torch.searchsorted(keys, torch.tensor([start*num_entities, stop*num_entities], device=model.device)).tolist()
+        if low == high:
+            continue
+        relations = torch.arange(start, stop, device=model.device)
+        fixed = torch.full((stop - start,), entity, device=model.device)
+        if side == 'head':
+            block = model.score_t(torch.stack((fixed, relations), dim=1)).detach()
+        else:
+            block = model.score_h(torch.stack((relations, fixed), dim=1)).detach()
+        yield block.flatten(-2)[..., keys[low:high] - start*num_entities]
+
+def scoreNegativeKeys(model, entity: int, side: str, keys: torch.Tensor, num_entities: int, num_relations: int) -> torch.Tensor:
+    '''
+    scores of all negatives of iterNegativeKeyBlocks together, in order of the keys
+    '''
+    blocks = list(iterNegativeKeyBlocks(model, entity, side, keys, num_entities, num_relations))
+    if len(blocks) == 0:
+        return torch.empty(0, device=model.device)
+    return torch.cat(blocks, dim=-1)
 
-def getReliKScore(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: set[tuple[int,int,int]], alltriples: TriplesFactory, samples: float, dataset: str) -> float:
+def countHigherNegatives(model, entities: list[int], side: str, keys: list[torch.Tensor], scores: torch.Tensor, score_seg: torch.Tensor, num_entities: int, num_relations: int) -> torch.Tensor:
+    '''
+    number of negatives strictly higher than each of the given scores, where keys[j] are the negatives of entities[j]
+    and score_seg tells for every score to which entity it belongs
+    negatives on the 1-N grid are counted block by block per entity, the others are streamed through score_hrt
+    '''
+    grid = scoreOnGrid(keys, num_entities, num_relations)
+    streamed = [j for j in range(len(keys)) if not grid[j]]
+    counts = torch.zeros(scores.shape, dtype=torch.long, device=scores.device)
+    for j in range(len(keys)):
+        if not grid[j]:
+            continue
+        idx = torch.nonzero(score_seg == j).flatten().to(scores.device)
+        if len(idx) == 0:
+            continue
+        entity_scores = scores[..., idx]
+        for block in iterNegativeKeyBlocks(model, entities[j], side, keys[j], num_entities, num_relations):
+            counts[..., idx] += countHigher(torch.sort(block)[0], entity_scores).to(scores.device)
+    if len(streamed) > 0:
+        neg_seg = torch.repeat_interleave(torch.LongTensor(streamed), torch.LongTensor([len(keys[j]) for j in streamed]))
+        candidates = torch.cat([decode_id_to_tensor(keys[j], entities[j], num_entities, num_relations, side) for j in streamed])
+        counts += countHigherStreamed(model, candidates, scores, neg_seg, score_seg, len(keys))
+    return counts
+
+# score the models of the folds together as one emb.ModelEnsemble in the heuristics
+stacked_scoring = True
+# ensemble of the models last given to getEnsemble
+model_ensemble = None
+
+def getEnsemble(models: list[object]):
+    '''
+    ModelEnsemble of the models, built once per list of models; without stacked_scoring the models are scored one after the other
+    '''
+    global model_ensemble
+    if model_ensemble is None or len(model_ensemble.models) != len(models) or any(a is not b for a, b in zip(model_ensemble.models, models)) or model_ensemble.stacked != (stacked_scoring and emb.ModelEnsemble.stackable(models)):
+        # the cached negative scores are keyed by the ensemble
+        clearNegScoreCache()
+        model_ensemble = emb.ModelEnsemble(models, stack=stacked_scoring)
+    return model_ensemble
+
+def getReliKScore(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: ti.TripleIndex, alltriples: TriplesFactory, samples: float, dataset: str) -> float:
     '''
     get exact ReliK score
     '''
     global getkHopneighbors_time
-    global entity_relation_loop_time
     global model_loop_time
 
     start_time = timeit.default_timer() #profiling 1
-    subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(u,v,M)
+    existing = dh.getEdgeLabels(u,v,M)
     end_time = timeit.default_timer()
     getkHopneighbors_time += end_time - start_time #profiling 1
 
@@ -773,62 +755,22 @@ def getReliKScore(u: str, v: str, M: nx.MultiDiGraph, models: list[object], enti
         head = entity_to_id_map[u]
         tail = entity_to_id_map[v]
 
-    first_u = True
-    first_v = True
-
-    start_time = timeit.default_timer() #profiling 2
-    for ent in range(alltriples.num_entities):
-        for rel in range(alltriples.num_relations):
-            kg_neg_triple_tuple = (entity_to_id_map[u],rel,ent)
-            if kg_neg_triple_tuple not in all_triples_set:
-                if first_u:
-                    first_u = False
-                    rslt_torch_u = torch.LongTensor([entity_to_id_map[u],rel,ent])
-                    rslt_torch_u = rslt_torch_u.resize_(1,3)
-                else:
-                    rslt_torch_u = torch.cat((rslt_torch_u, torch.LongTensor([entity_to_id_map[u],rel,ent]).resize_(1,3)))
-
-            kg_neg_triple_tuple = (ent,rel,entity_to_id_map[v])
-            if kg_neg_triple_tuple not in all_triples_set:
-                if first_v:
-                    first_v = False
-                    rslt_torch_v = torch.LongTensor([ent,rel,entity_to_id_map[v]])
-                    rslt_torch_v = rslt_torch_v.resize_(1,3)
-                else:
-                    rslt_torch_v = torch.cat((rslt_torch_v, torch.LongTensor([ent,rel,entity_to_id_map[v]]).resize_(1,3)))
-    
-    end_time = timeit.default_timer()
-    entity_relation_loop_time += end_time - start_time #profiling 2
+    # all (relation, entity) candidates for u as head and for v as tail, without known triples
+    def negativesHead(entity):
+        return all_triples_set.negativeKeys(entity, side='head')
+    def negativesTail(entity):
+        return all_triples_set.negativeKeys(entity, side='tail')
 
-    first = True
-    for tp in list(existing):
-        if first:
-            first = False
-            ex_torch = torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]])
-            ex_torch = ex_torch.resize_(1,3)
-        else:
-            ex_torch = torch.cat((ex_torch, torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]]).resize_(1,3)))
-
-    hRankNeg = 0
-    tRankNeg = 0
+    ex_torch = torch.LongTensor([[head,relation_to_id_map[tp],tail] for tp in existing])
 
     start_time = timeit.default_timer() #profiling 3
-    for i in range(len(models)):
-        # make sure the model is on GPU
-        #models[i].to('cuda')
-
-        comp_score = models[i].score_hrt(ex_torch).cpu()
-        rslt_u_score = models[i].score_hrt(rslt_torch_u)
-        rslt_v_score = models[i].score_hrt(rslt_torch_v)
-        count = 0
-        he_sc = 0
-        ta_sc = 0
-        for tr in comp_score:
-            count += 1
-            he_sc += torch.sum(rslt_u_score > tr).detach().numpy() + 1
-            ta_sc += torch.sum(rslt_v_score > tr).detach().numpy() + 1
-        hRankNeg += (he_sc /len(models))
-        tRankNeg += (ta_sc /len(models))
+    # all models at once, one row per model
+    ensemble = getEnsemble(models)
+    comp_score = ensemble.score_hrt(ex_torch).detach().squeeze(-1)
+    rslt_u_score = getSortedNegScores(ensemble, [head], 'head', negativesHead, all_triples_set.num_entities, all_triples_set.num_relations)[0]
+    rslt_v_score = getSortedNegScores(ensemble, [tail], 'tail', negativesTail, all_triples_set.num_entities, all_triples_set.num_relations)[0]
+    hRankNeg = torch.sum(countHigher(rslt_u_score, comp_score) + 1).item() / len(models)
+    tRankNeg = torch.sum(countHigher(rslt_v_score, comp_score) + 1).item() / len(models)
     
     end_time = timeit.default_timer()
     model_loop_time += end_time - start_time #profiling 3
@@ -839,161 +781,70 @@ def getReliKScore(u: str, v: str, M: nx.MultiDiGraph, models: list[object], enti
 
 # We need a more fine grained profiling to understand the bottlenecks in sampling
 random_choice_time = 0.0
+# random generator of the binomial sampler
+sample_rng = np.random.default_rng()
 
 
-def binomial(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: set[tuple[int,int,int]], num_entities: int, num_relations: int, sample: float, dataset: str) -> float:
+def binomialNegatives(entity: int, side: str, all_triples_set: ti.TripleIndex, num_entities: int, num_relations: int, sample: float) -> tuple[torch.Tensor, int]:
     '''
-    get approximate ReliK score with binomial approximation
+    draw the negatives of the binomial approximation for a fixed head (side='head') or tail (side='tail')
+    returns the sample as keys relation*num_entities+other and the number of negatives the sample stands for
     '''
-    #list(map(random.choice, map(list, list_of_sets)))
-
-    global getkHopneighbors_time
     global sample_time
-    global model_loop_time
     global sample_first_while_time
     global sample_second_while_time
 
-    start_time = timeit.default_timer() # profiling 1
-    subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(u,v,M)
-    end_time = timeit.default_timer() # profiling 1
-    getkHopneighbors_time += end_time - start_time # profiling 1
-
     start_time = timeit.default_timer() # profiling 2
-    #print(entity_to_id_map)
-    #subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(entity_to_id_map[u],entity_to_id_map[v],M)
     if sample > 0.4:
-        allset_uu = set(itertools.product([entity_to_id_map[u]],range(num_relations),range(num_entities)))
-        allset_vv = set(itertools.product(range(num_entities),range(num_relations),[entity_to_id_map[v]]))
-        len_uu = len(allset_uu.difference(all_triples_set))
-        len_vv = len(allset_vv.difference(all_triples_set))
-
-        allset = set()
-        allset_u = set()
-        allset_v = set()
-        
-        lst_emb = list(range(num_entities))
-        lst_emb_r = list(range(num_relations))
-
-        first = True
-        count = 0
-        while len(allset_u) < len_uu * sample:
-        #while len(allset_u) < min(len_uu*sample,1000):
-            #count += 1
-            relation = random.choice(lst_emb_r)
-            tail = random.choice(lst_emb)
-            kg_neg_triple_tuple = (entity_to_id_map[u],relation,tail)
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_u:
-                if first:
-                    first = False
-                    rslt_torch_u = torch.LongTensor([entity_to_id_map[u],relation,tail])
-                    rslt_torch_u = rslt_torch_u.resize_(1,3)
-                else:
-                    rslt_torch_u = torch.cat((rslt_torch_u, torch.LongTensor([entity_to_id_map[u],relation,tail]).resize_(1,3)))
-                allset_u.add(kg_neg_triple_tuple)
-            else:
-                count += 1
-            #if count == len_uu*sample:#min(len_uu*sample,1000):
-            #    break
-        count = 0
-        first = True
-        while len(allset_v) < len_vv * sample:
-        #while len(allset_v) < min(len_vv*sample,1000):
-            #count += 1
-            relation = random.choice(lst_emb_r)
-            head = random.choice(lst_emb)
-            kg_neg_triple_tuple = (head,relation,entity_to_id_map[v])
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_v:
-                if first:
-                    first = False
-                    rslt_torch_v = torch.LongTensor([head,relation,entity_to_id_map[v]])
-                    rslt_torch_v = rslt_torch_v.resize_(1,3)
-                else:
-                    rslt_torch_v = torch.cat((rslt_torch_v, torch.LongTensor([head,relation,entity_to_id_map[v]]).resize_(1,3)))
-                allset_v.add(kg_neg_triple_tuple)
-            else:
-                count += 1
+        len_all = gs.negativeCount(all_triples_set, entity, side)
     else:
-        allset_u = set()
-        allset_v = set()
-        len_uu = num_entities*num_relations
-        len_vv = num_entities*num_relations
-        first = True
-        start_first_while = timeit.default_timer() # profiling 4
-        
-        while len(allset_u) < len_uu * sample:
-        #while len(allset_u) < min(len_uu*sample,1000):
-
-            kg_neg_triple_tuple = tuple(map(random.choice, map(list, [range(num_relations),range(num_entities)] )))
-            
-            # optimization: sampling without replacement
-            kg_neg_triple_tuple = (entity_to_id_map[u], kg_neg_triple_tuple[0], kg_neg_triple_tuple[1])
-            
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_u:
-                if first:
-                    first = False
-                    rslt_torch_u = torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]])
-                    rslt_torch_u = rslt_torch_u.resize_(1,3)
-                else:
-                    rslt_torch_u = torch.cat((rslt_torch_u, torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]]).resize_(1,3)))
-                allset_u.add(kg_neg_triple_tuple)
-        #print(len(rslt_torch_u))
-
-        end_first_while = timeit.default_timer() # profiling 4
-        sample_first_while_time += end_first_while - start_first_while # profiling 4
-
-        first = True
-
-        start_second_while = timeit.default_timer() # profiling 5
-
-        while len(allset_v) < len_vv * sample:
-        #while len(allset_v) < min(len_vv*sample,1000):
-            kg_neg_triple_tuple = tuple(map(random.choice, map(list, [range(num_relations),range(num_entities)] )))
-            kg_neg_triple_tuple = (kg_neg_triple_tuple[1], kg_neg_triple_tuple[0], entity_to_id_map[v])
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_v:
-                if first:
-                    first = False
-                    rslt_torch_v = torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]])
-                    rslt_torch_v = rslt_torch_v.resize_(1,3)
-                else:
-                    rslt_torch_v = torch.cat((rslt_torch_v, torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]]).resize_(1,3)))
-                allset_v.add(kg_neg_triple_tuple)
-        
+        len_all = num_entities*num_relations
 
-        end_second_while = timeit.default_timer() # profiling 5
-        sample_second_while_time += end_second_while - start_second_while # profiling 5
-
-    #print(len(rslt_torch_u))
-    #print(rslt_torch_v)
+    # draw the negatives without replacement as ranks among all not known (relation, entity) keys of the entity,
+    # the i-th not known key is i plus the number of known keys up to it
+    known = all_triples_set.knownKeys(entity, side)
+    n_negatives = gs.negativeCount(all_triples_set, entity, side)
+    ranks = sample_rng.choice(n_negatives, size=min(math.ceil(len_all * sample), n_negatives), replace=False)
+    keys = ranks + np.searchsorted(known - np.arange(len(known)), ranks, side='right')
+    rslt_torch = torch.from_numpy(keys)
 
     end_time = timeit.default_timer() # profiling 2
     sample_time += end_time - start_time # profiling 2
+    if side == 'head':
+        sample_first_while_time += end_time - start_time # profiling 4
+    else:
+        sample_second_while_time += end_time - start_time # profiling 5
+    return rslt_torch, len_all
 
-    first = True
-    for tp in list(existing):
-        if first:
-            first = False
-            ex_torch = torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]])
-            ex_torch = ex_torch.resize_(1,3)
-        else:
-            ex_torch = torch.cat((ex_torch, torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]]).resize_(1,3)))
+def binomial(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: ti.TripleIndex, num_entities: int, num_relations: int, sample: float, dataset: str) -> float:
+    '''
+    get approximate ReliK score with binomial approximation
+    '''
+    global getkHopneighbors_time
+    global model_loop_time
+
+    start_time = timeit.default_timer() # profiling 1
+    existing = dh.getEdgeLabels(u,v,M)
+    end_time = timeit.default_timer() # profiling 1
+    getkHopneighbors_time += end_time - start_time # profiling 1
+
+    head = entity_to_id_map[u]
+    tail = entity_to_id_map[v]
+    rslt_torch_u, len_uu = binomialNegatives(head, 'head', all_triples_set, num_entities, num_relations, sample)
+    rslt_torch_v, len_vv = binomialNegatives(tail, 'tail', all_triples_set, num_entities, num_relations, sample)
+
+    ex_torch = torch.LongTensor([[entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]] for tp in existing])
 
-    hRankNeg = 0
-    tRankNeg = 0
     #print(f"Here: {os.getpid()}")
     start_time = timeit.default_timer() # profiling 3
-    for i in range(len(models)):
-        comp_score = models[i].score_hrt(ex_torch).cpu()
-        rslt_u_score = models[i].score_hrt(rslt_torch_u)
-        rslt_v_score = models[i].score_hrt(rslt_torch_v)
-        count = 0
-        he_sc = 0
-        ta_sc = 0
-        for tr in comp_score:
-            count += 1
-            he_sc += torch.sum(rslt_u_score > tr).detach().numpy() + 1
-            ta_sc += torch.sum(rslt_v_score > tr).detach().numpy() + 1
-        hRankNeg += ((he_sc / len(allset_u))/len(models)) * len_uu
-        tRankNeg += ((ta_sc / len(allset_v))/len(models)) * len_vv
+    # all models at once, one row per model
+    ensemble = getEnsemble(models)
+    comp_score = ensemble.score_hrt(ex_torch).detach().squeeze(-1)
+    pos_seg = torch.zeros(comp_score.shape[-1], dtype=torch.long)
+    he_sc = torch.sum(countHigherNegatives(ensemble, [head], 'head', [rslt_torch_u], comp_score, pos_seg, num_entities, num_relations) + 1).item()
+    ta_sc = torch.sum(countHigherNegatives(ensemble, [tail], 'tail', [rslt_torch_v], comp_score, pos_seg, num_entities, num_relations) + 1).item()
+    hRankNeg = ((he_sc / len(rslt_torch_u))/len(models)) * len_uu
+    tRankNeg = ((ta_sc / len(rslt_torch_v))/len(models)) * len_vv
     end_time = timeit.default_timer() # profiling 3
     model_loop_time += end_time - start_time # profiling 3
 
@@ -1002,203 +853,252 @@ def binomial(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to
 
 # this is the optimized version of the binomial approximation
 
-def pre_randperm(num_entities: int, num_relations: int, device='cuda') -> torch.Tensor:
+def pre_randperm(num_entities: int, num_relations: int, device='cpu') -> torch.Tensor:
     perm_entities = torch.randperm(num_entities, device=device)
     perm_relations = torch.randperm(num_relations, device=device)
     return perm_entities, perm_relations
 
 perm_entities = None
 perm_relations = None
-all_triple_id_torch = None
 
 #sampled_indices_only_once = None
 
-def encode_triples_to_id(triples, entity_count: int, relation_count: int, device='cuda') -> torch.tensor:
-    entity1, relation, entity2 = triples[:, 0], triples[:, 1], triples[:, 2]
-    return entity1 * relation_count * entity_count + relation * entity_count + entity2
+# Triples are encoded relative to their fixed head or tail as relation * entity_count + other entity,
+# the same keys the TripleIndex stores per entity. The ids stay below entity_count * relation_count,
+# so they can not overflow int64 for any graph size (a global head * relation_count * entity_count + ... id can)
 
-def decode_id_to_tensor(encoded_ids, entity_count: int, relation_count: int, device='cuda') -> torch.tensor:
-    entity1 = encoded_ids // (relation_count * entity_count)
-    remaining = encoded_ids % (relation_count * entity_count)
-    relation = remaining // entity_count
-    entity2 = remaining % entity_count
-    triple_tensor = torch.stack((entity1, relation, entity2), dim=-1)
-    return triple_tensor
+def encode_triples_to_id(triples, entity_count: int, relation_count: int, side: str='head') -> torch.tensor:
+    if side == 'head':
+        return triples[:, 1] * entity_count + triples[:, 2]
+    return triples[:, 1] * entity_count + triples[:, 0]
 
-def binomial_cuda(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, 
-             relation_to_id_map: object, all_triples_set: set[tuple[int,int,int]], 
-             num_entities: int, num_relations: int, sample: float, dataset: str, device='cuda', this_perm_entities=None, this_perm_relations=None, all_triple_id_torch = None) -> float:
+def decode_id_to_tensor(encoded_ids, entity: int, entity_count: int, relation_count: int, side: str='head') -> torch.tensor:
+    relation = encoded_ids // entity_count
+    other = encoded_ids % entity_count
+    fixed = torch.full_like(encoded_ids, entity)
+    if side == 'head':
+        return torch.stack((fixed, relation, other), dim=-1)
+    return torch.stack((other, relation, fixed), dim=-1)
+
+def sampleNegativeKeysCycle(entity: int, side: str, all_triples_set: ti.TripleIndex, num_entities: int, num_relations: int, sample: float, device='cpu', this_perm_entities=None, this_perm_relations=None) -> torch.Tensor:
     '''
-    Get approximate ReliK score with binomial approximation (optimized sampling)
+    sample negatives for a fixed head (side='head') or tail (side='tail') by cycling through the pre-drawn permutations
+    returns the negatives as keys relation*num_entities+other
     '''
-    #list(map(random.choice, map(list, list_of_sets)))
-
-    global getkHopneighbors_time
     global sample_time
-    global model_loop_time
     global sample_first_while_time
     global sample_second_while_time
 
-    start_time = timeit.default_timer() # profiling 1
-    subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(u,v,M)
-    end_time = timeit.default_timer() # profiling 1
-    getkHopneighbors_time += end_time - start_time # profiling 1
-
     start_time = timeit.default_timer() # profiling 2
-    #print(entity_to_id_map)
-    #subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(entity_to_id_map[u],entity_to_id_map[v],M)
-    if sample >= 0:
-        allset_u = set()
-        allset_v = set()
-        len_uu = num_entities*num_relations
-        len_vv = num_entities*num_relations
-        first = True
-        start_first_while = timeit.default_timer() # profiling 4
-        """
-        while len(allset_u) < min(len_uu*sample,1000):
-            kg_neg_triple_tuple = tuple(map(random.choice, map(list, [range(alltriples.num_relations),range(alltriples.num_entities)] )))
-            
-            # optimization: sampling without replacement
-            kg_neg_triple_tuple = (entity_to_id_map[u], kg_neg_triple_tuple[0], kg_neg_triple_tuple[1])
-            
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_u:
-                if first:
-                    first = False
-                    rslt_torch_u = torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]])
-                    rslt_torch_u = rslt_torch_u.resize_(1,3)
-                else:
-                    rslt_torch_u = torch.cat((rslt_torch_u, torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]]).resize_(1,3)))
-                allset_u.add(kg_neg_triple_tuple)
-        """
-        # Directly sample 20% more indices without checking for negativities
-        # Also assume there is no duplicates in sampling_tensor
-
-        target_length = int(len_uu * sample * 1.2)
-
-        entity_repeats = (target_length + len(this_perm_entities) - 1) // len(this_perm_entities)
-        relation_repeats = (target_length + len(this_perm_relations) - 1) // len(this_perm_relations)
-        
-        head_cycle = torch.full((target_length,), entity_to_id_map[u], device=device)
-        entity_cycle = this_perm_entities.repeat(entity_repeats)[:target_length]
-        relation_cycle = this_perm_relations.repeat(relation_repeats)[:target_length]
-
-        # stack the indices
-        sampling_tensor = torch.stack([head_cycle, relation_cycle, entity_cycle], dim=1)
-
-        sampling_triple_id = encode_triples_to_id(sampling_tensor, num_entities, num_relations, device='cuda')
+    # Directly sample 20% more indices without checking for negativities
+    # Also assume there is no duplicates in sampling_tensor
+    target_length = int(num_entities * num_relations * sample * 1.2)
 
+    # WARNING: Assuming that the number of entities and relations is relatively prime
+    entity_repeats = (target_length + len(this_perm_entities) - 1) // len(this_perm_entities)
+    relation_repeats = (target_length + len(this_perm_relations) - 1) // len(this_perm_relations)
 
-        #compareview = all_triple_id_torch.repeat(sampling_triple_id.shape[0], 1).T.to(device)
+    fixed_cycle = torch.full((target_length,), entity, device=device)
+    entity_cycle = this_perm_entities.repeat(entity_repeats)[:target_length]
+    relation_cycle = this_perm_relations.repeat(relation_repeats)[:target_length]
 
-        #print(sampling_triple_id.device, all_triple_id_torch.device)
-
-        # Non-intersection (sampling except positive)
-        
-        only_negative_triples = sampling_triple_id[~torch.isin(sampling_triple_id, all_triple_id_torch)].clone().detach()
-
-        allset_u = decode_id_to_tensor(only_negative_triples, num_entities, num_relations)
+    # stack the indices
+    if side == 'head':
+        sampling_tensor = torch.stack([fixed_cycle, relation_cycle, entity_cycle], dim=1)
+    else:
+        sampling_tensor = torch.stack([entity_cycle, relation_cycle, fixed_cycle], dim=1)
 
-        #print(len(rslt_torch_u))
-        #print(rslt_torch_u[:5])
+    sampling_triple_id = encode_triples_to_id(sampling_tensor, num_entities, num_relations, side)
 
-        end_first_while = timeit.default_timer() # profiling 4
-        sample_first_while_time += end_first_while - start_first_while # profiling 4
+    # Non-intersection (sampling except positive), only against the known triples of this entity
+    known_triple_id = torch.from_numpy(all_triples_set.knownKeys(entity, side)).to(device)
+    negatives = sampling_triple_id[~torch.isin(sampling_triple_id, known_triple_id)].clone().detach()
 
-        first = True
+    end_time = timeit.default_timer() # profiling 2
+    sample_time += end_time - start_time # profiling 2
+    if side == 'head':
+        sample_first_while_time += end_time - start_time # profiling 4
+    else:
+        sample_second_while_time += end_time - start_time # profiling 5
+    return negatives
 
-        start_second_while = timeit.default_timer() # profiling 5
-        """
-        while len(allset_v) < min(len_vv*sample,1000):
-            kg_neg_triple_tuple = tuple(map(random.choice, map(list, [range(alltriples.num_relations),range(alltriples.num_entities)] )))
-            kg_neg_triple_tuple = (kg_neg_triple_tuple[1], kg_neg_triple_tuple[0], entity_to_id_map[v])
-            if kg_neg_triple_tuple not in all_triples_set and kg_neg_triple_tuple not in allset_u:
-                if first:
-                    first = False
-                    rslt_torch_v = torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]])
-                    rslt_torch_v = rslt_torch_v.resize_(1,3)
-                else:
-                    rslt_torch_v = torch.cat((rslt_torch_v, torch.LongTensor([kg_neg_triple_tuple[0],kg_neg_triple_tuple[1],kg_neg_triple_tuple[2]]).resize_(1,3)))
-                allset_v.add(kg_neg_triple_tuple)
-        """
-        # Directly sample 20% more indices without checking for negativities
-        # Also assume there is no duplicates in sampling_tensor
-        
-        target_length = int(len_vv * sample * 1.2)
-        #target_length = int(min(len_vv*sample, 1000) * 1.2)
-        #global perm_relations, perm_entities, all_triple_id_torch
+def binomial_cuda(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, 
+             relation_to_id_map: object, all_triples_set: ti.TripleIndex, 
+             num_entities: int, num_relations: int, sample: float, dataset: str, device='cpu', this_perm_entities=None, this_perm_relations=None) -> float:
+    '''
+    Get approximate ReliK score with binomial approximation (optimized sampling)
+    The sample of an entity only depends on the permutations, so the sorted negative scores are cached per entity
+    '''
+    global getkHopneighbors_time
+    global model_loop_time
 
-        # WARNING: Assuming that the number of entities and relations is relatively prime
-        entity_repeats = (target_length + len(this_perm_entities) - 1) // len(this_perm_entities)
-        relation_repeats = (target_length + len(this_perm_relations) - 1) // len(this_perm_relations)
+    start_time = timeit.default_timer() # profiling 1
+    existing = dh.getEdgeLabels(u,v,M)
+    end_time = timeit.default_timer() # profiling 1
+    getkHopneighbors_time += end_time - start_time # profiling 1
 
-        tail_cycle = torch.full((target_length,), entity_to_id_map[v], device=device)
-        entity_cycle = this_perm_entities.repeat(entity_repeats)[:target_length]
-        relation_cycle = this_perm_relations.repeat(relation_repeats)[:target_length]
+    head = entity_to_id_map[u]
+    tail = entity_to_id_map[v]
+    len_uu = num_entities*num_relations
+    len_vv = num_entities*num_relations
 
-        # stack the indices
-        sampling_tensor = torch.stack([entity_cycle, relation_cycle, tail_cycle], dim=1)
+    def sampleHead(entity):
+        return sampleNegativeKeysCycle(entity, 'head', all_triples_set, num_entities, num_relations, sample, device, this_perm_entities, this_perm_relations)
+    def sampleTail(entity):
+        return sampleNegativeKeysCycle(entity, 'tail', all_triples_set, num_entities, num_relations, sample, device, this_perm_entities, this_perm_relations)
 
-        sampling_triple_id = encode_triples_to_id(sampling_tensor, num_entities, num_relations, device='cuda')
+    ex_torch = torch.LongTensor([[head,relation_to_id_map[tp],tail] for tp in existing]).to(device)
 
-        # Non-intersection (sampling except positive)
+    start_time = timeit.default_timer() # profiling 3
+    # all models at once, one row per model, sharing the sample of an entity
+    ensemble = getEnsemble(models)
+    comp_score = ensemble.score_hrt(ex_torch).detach().squeeze(-1)
+    rslt_u_score = getSortedNegScores(ensemble, [head], 'head', sampleHead, num_entities, num_relations, tag=f'binomial_cuda_{sample}')[0]
+    rslt_v_score = getSortedNegScores(ensemble, [tail], 'tail', sampleTail, num_entities, num_relations, tag=f'binomial_cuda_{sample}')[0]
+    he_sc = torch.sum(countHigher(rslt_u_score, comp_score) + 1).item()
+    ta_sc = torch.sum(countHigher(rslt_v_score, comp_score) + 1).item()
+    hRankNeg = ((he_sc / rslt_u_score.shape[-1])/len(models)) * len_uu
+    tRankNeg = ((ta_sc / rslt_v_score.shape[-1])/len(models)) * len_vv
+    end_time = timeit.default_timer() # profiling 3
+    model_loop_time += end_time - start_time # profiling 3
 
-        only_negative_triples = sampling_triple_id[~torch.isin(sampling_triple_id, all_triple_id_torch)].clone().detach()
+    #print(( 1/hRankNeg + 1/tRankNeg )/2, 1/hRankNeg, 1/tRankNeg)
+    return ( 1/hRankNeg + 1/tRankNeg )/2, 1/hRankNeg, 1/tRankNeg
 
-        allset_v = decode_id_to_tensor(only_negative_triples, num_entities, num_relations)
+# number of edges that are scored together, with one scoring pass per model
+edge_batch_size = 256
+# heuristics with a batched version in scoreEdgeBatch
+batched_heuristics = ('getReliKScore', 'binomial', 'binomial_cuda')
 
-        end_second_while = timeit.default_timer() # profiling 5
-        sample_second_while_time += end_second_while - start_second_while # profiling 5
+def countHigherSegments(neg_scores: torch.Tensor, neg_seg: torch.Tensor, pos_scores: torch.Tensor, pos_seg: torch.Tensor, num_segments: int) -> torch.Tensor:
+    '''
+    number of negatives strictly higher than each positive, only counting the negatives of the same segment
+    (K,N) negative and (K,M) positive scores of a ModelEnsemble are counted per model
+    '''
+    device = neg_scores.device
+    if neg_scores.dim() == 2:
+        # every model gets its own block of segments
+        rows = neg_scores.shape[0]
+        offset = torch.arange(rows, device=device).unsqueeze(1) * num_segments
+        neg_seg = (neg_seg.to(device).unsqueeze(0) + offset).flatten()
+        pos_seg = (pos_seg.to(device).unsqueeze(0) + offset).flatten()
+        return countHigherSegments(neg_scores.flatten(), neg_seg, pos_scores.flatten(), pos_seg, rows * num_segments).reshape(rows, -1)
+    neg_seg = neg_seg.to(device)
+    pos_seg = pos_seg.to(device)
+    n_neg = neg_scores.shape[0]
+    scores = torch.cat((neg_scores, pos_scores.to(device)))
+    seg = torch.cat((neg_seg, pos_seg))
+    # sort by segment, then score; negatives come first, so the stable sorts keep them in front of equally scored positives
+    order = torch.sort(scores, stable=True)[1]
+    order = order[torch.sort(seg[order], stable=True)[1]]
+    neg_upto = torch.cumsum((order < n_neg).long(), 0)
+    neg_count = torch.bincount(neg_seg, minlength=num_segments)
+    neg_before_seg = torch.cumsum(neg_count, 0) - neg_count
+
+    pos_at = order >= n_neg
+    pos_idx = order[pos_at] - n_neg
+    pos_seg_sorted = pos_seg[pos_idx]
+    higher = torch.empty_like(pos_seg)
+    higher[pos_idx] = neg_count[pos_seg_sorted] - (neg_upto[pos_at] - neg_before_seg[pos_seg_sorted])
+    return higher
+
+def scoreEdgeBatch(heur, edges: list[tuple[str,str]], M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: ti.TripleIndex, full_graph: TriplesFactory, sample: float, dataset: str, device='cpu', this_perm_entities=None, this_perm_relations=None) -> list[tuple[float,float,float]]:
+    '''
+    ReliK score, head and tail part of the chosen heuristic for a batch of (u, v) edges
+    all positives and all not yet scored negatives of the batch are scored together with one pass over all models,
+    heuristics without a batched version (lower_bound, RR) are called edge by edge
+    '''
+    global getkHopneighbors_time
+    global model_loop_time
 
-    rslt_torch_u = allset_u
-    rslt_torch_v = allset_v
+    if heur.__name__ not in batched_heuristics:
+        return [heur(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, dataset) for u, v in edges]
 
-    end_time = timeit.default_timer() # profiling 2
-    sample_time += end_time - start_time # profiling 2
+    num_entities = full_graph.num_entities
+    num_relations = full_graph.num_relations
+    n_edges = len(edges)
+    if dataset == 'Yago2':
+        heads = [u for u, v in edges]
+        tails = [v for u, v in edges]
+    else:
+        heads = [entity_to_id_map[u] for u, v in edges]
+        tails = [entity_to_id_map[v] for u, v in edges]
 
-    first = True
-    for tp in list(existing):
-        if first:
-            first = False
-            ex_torch = torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]])
-            ex_torch = ex_torch.resize_(1,3)
-        else:
-            ex_torch = torch.cat((ex_torch, torch.LongTensor([entity_to_id_map[u],relation_to_id_map[tp],entity_to_id_map[v]]).resize_(1,3)))
+    # positives of all edges, pos_edge tells to which edge a positive belongs
+    start_time = timeit.default_timer() # profiling 1
+    # M holds the same triples as the index, so the u->v relations are read from the index (its CSR adjacency) instead of M
+    ex_relations = [torch.from_numpy(all_triples_set.knownRelations(heads[j], tails[j])) for j in range(n_edges)]
+    pos_edge = torch.repeat_interleave(torch.arange(n_edges), torch.LongTensor([len(relations) for relations in ex_relations]))
+    ex_relations = torch.cat(ex_relations)
+    ex_torch = torch.stack((torch.LongTensor(heads)[pos_edge], ex_relations, torch.LongTensor(tails)[pos_edge]), dim=1).to(device)
+    end_time = timeit.default_timer() # profiling 1
+    getkHopneighbors_time += end_time - start_time # profiling 1
 
-    hRankNeg = 0
-    tRankNeg = 0
+    if heur.__name__ == 'binomial':
+        # fresh sample per edge, concatenated with the edge as segment
+        samples_u = [binomialNegatives(head, 'head', all_triples_set, num_entities, num_relations, sample) for head in heads]
+        samples_v = [binomialNegatives(tail, 'tail', all_triples_set, num_entities, num_relations, sample) for tail in tails]
+        keys_u = [rslt for rslt, len_all in samples_u]
+        keys_v = [rslt for rslt, len_all in samples_v]
+        # factor from the counted rank to the estimated rank
+        factor_u = torch.DoubleTensor([len_all / len(rslt) for rslt, len_all in samples_u])
+        factor_v = torch.DoubleTensor([len_all / len(rslt) for rslt, len_all in samples_v])
+    elif heur.__name__ == 'binomial_cuda':
+        def negativesHead(entity):
+            return sampleNegativeKeysCycle(entity, 'head', all_triples_set, num_entities, num_relations, sample, device, this_perm_entities, this_perm_relations)
+        def negativesTail(entity):
+            return sampleNegativeKeysCycle(entity, 'tail', all_triples_set, num_entities, num_relations, sample, device, this_perm_entities, this_perm_relations)
+        tag = f'binomial_cuda_{sample}'
+    else:
+        def negativesHead(entity):
+            return all_triples_set.negativeKeys(entity, side='head')
+        def negativesTail(entity):
+            return all_triples_set.negativeKeys(entity, side='tail')
+        tag = 'exact'
 
+    hRankNeg = torch.zeros(n_edges, dtype=torch.float64)
+    tRankNeg = torch.zeros(n_edges, dtype=torch.float64)
 
     start_time = timeit.default_timer() # profiling 3
-    for i in range(len(models)):
-        comp_score = models[i].score_hrt(ex_torch).cpu()
-        rslt_u_score = models[i].score_hrt(rslt_torch_u)
-        rslt_v_score = models[i].score_hrt(rslt_torch_v)
-        count = 0
-        he_sc = 0
-        ta_sc = 0
-        for tr in comp_score:
-            count += 1
-            he_sc += torch.sum(rslt_u_score > tr).detach().numpy() + 1
-            ta_sc += torch.sum(rslt_v_score > tr).detach().numpy() + 1
-        hRankNeg += ((he_sc / len(allset_u))/len(models)) * len_uu
-        tRankNeg += ((ta_sc / len(allset_v))/len(models)) * len_vv
+    # all models at once, one row per model, the ranks are summed over the models and averaged
+    ensemble = getEnsemble(models)
+    comp_score = ensemble.score_hrt(ex_torch).detach().squeeze(-1)
+    if heur.__name__ == 'binomial':
+        he_rank = countHigherNegatives(ensemble, heads, 'head', keys_u, comp_score, pos_edge, num_entities, num_relations).cpu() + 1
+        ta_rank = countHigherNegatives(ensemble, tails, 'tail', keys_v, comp_score, pos_edge, num_entities, num_relations).cpu() + 1
+        he_sc = torch.zeros(n_edges, dtype=torch.float64).index_add_(0, pos_edge, he_rank.double().sum(0))
+        ta_sc = torch.zeros(n_edges, dtype=torch.float64).index_add_(0, pos_edge, ta_rank.double().sum(0))
+        hRankNeg += (he_sc * factor_u) / len(models)
+        tRankNeg += (ta_sc * factor_v) / len(models)
+    else:
+        # negatives only depend on the entity, so every distinct head and tail of the batch is looked up once
+        for side, entities, negatives, rank_neg in (('head', heads, negativesHead, hRankNeg), ('tail', tails, negativesTail, tRankNeg)):
+            unique_entities = list(dict.fromkeys(entities))
+            position = {entity: j for j, entity in enumerate(unique_entities)}
+            pos_entity = torch.LongTensor([position[entities[j]] for j in pos_edge.tolist()])
+            sc = torch.zeros(n_edges, dtype=torch.float64)
+            # the negative scores of one entity are used and released before the next entity is scored
+            for j, entity_scores in enumerate(iterSortedNegScores(ensemble, unique_entities, side, negatives, num_entities, num_relations, tag=tag)):
+                idx = torch.nonzero(pos_entity == j).flatten()
+                rank = countHigher(entity_scores, comp_score[:, idx.to(comp_score.device)]).cpu() + 1
+                if heur.__name__ == 'binomial_cuda':
+                    rank = rank.double() * (num_entities*num_relations) / entity_scores.shape[-1]
+                sc.index_add_(0, pos_edge[idx], rank.double().sum(0))
+                del entity_scores
+            rank_neg += sc / len(models)
     end_time = timeit.default_timer() # profiling 3
     model_loop_time += end_time - start_time # profiling 3
 
-    #print(( 1/hRankNeg + 1/tRankNeg )/2, 1/hRankNeg, 1/tRankNeg)
-    return ( 1/hRankNeg + 1/tRankNeg )/2, 1/hRankNeg, 1/tRankNeg
+    return [(((1/h) + (1/t))/2, 1/h, 1/t) for h, t in zip(hRankNeg.tolist(), tRankNeg.tolist())]
 
-def lower_bound(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: set[tuple[int,int,int]], alltriples: TriplesFactory, sample: float, dataset: str) -> float:
+def lower_bound(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: ti.TripleIndex, alltriples: TriplesFactory, sample: float, dataset: str) -> float:
     '''
     get approximate ReliK score with lower bound approximation
     '''
-    subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(u,v,M)
-
-    allset_uu = set(itertools.product([entity_to_id_map[u]],range(alltriples.num_relations),range(alltriples.num_entities)))
-    allset_vv = set(itertools.product(range(alltriples.num_entities),range(alltriples.num_relations),[entity_to_id_map[v]]))
+    existing = dh.getEdgeLabels(u,v,M)
 
-    len_uu = len(allset_uu.difference(all_triples_set))
-    len_vv = len(allset_vv.difference(all_triples_set))
+    len_uu = gs.negativeCount(all_triples_set, entity_to_id_map[u], 'head')
+    len_vv = gs.negativeCount(all_triples_set, entity_to_id_map[v], 'tail')
 
     allset_u = set()
     allset_v = set()
@@ -1262,25 +1162,19 @@ def lower_bound(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity
     hRankNeg = 0
     tRankNeg = 0
     for i in range(len(models)):
-        comp_score = models[i].score_hrt(ex_torch).cpu()
-        rslt_u_score = models[i].score_hrt(rslt_torch_u)
-        rslt_v_score = models[i].score_hrt(rslt_torch_v)
-        count = 0
-        he_sc = 0
-        ta_sc = 0
-        for tr in comp_score:
-            count += 1
-            he_sc += torch.sum(rslt_u_score > tr).detach().numpy() + 1
-            ta_sc += torch.sum(rslt_v_score > tr).detach().numpy() + 1
+        comp_score = models[i].score_hrt(ex_torch).detach().flatten()
+        he_sc = torch.sum(countHigherStreamed(models[i], rslt_torch_u, comp_score) + 1).item()
+        ta_sc = torch.sum(countHigherStreamed(models[i], rslt_torch_v, comp_score) + 1).item()
         hRankNeg += (he_sc + len_uu - len(allset_u))/len(models)
         tRankNeg += (ta_sc + len_vv - len(allset_v))/len(models)
 
     return ( 1/hRankNeg + 1/tRankNeg )/2
 
-def densestSubgraph(datasetname, embedding, score_calculation, sample, models):
+def densestSubgraph(datasetname, embedding, score_calculation, sample, models, device=None):
     '''
     compute and store the weights with chosen score approximation for densest subgraphs tests
     '''
+    device = resolveDevice(device)
     path = f"approach/KFold/{datasetname}_{5}_fold/{embedding}_weightedGraph_{score_calculation.__name__}_{sample}_samples.csv"
     isExist = os.path.exists(path)
     if False:
@@ -1304,9 +1198,7 @@ def densestSubgraph(datasetname, embedding, score_calculation, sample, models):
 
             full_graph = CoreTriplesFactory(ten,num_entities=len(entity_to_id_map),num_relations=len(relation_to_id_map))
             df = pd.DataFrame(full_graph.mapped_triples, columns=['subject', 'predicate', 'object'])
-            all_triples_set = set[tuple[int,int,int]]()
-            for tup in full_graph.mapped_triples.tolist():
-                all_triples_set.add((tup[0],tup[1],tup[2]))
+            all_triples_set = ti.TripleIndex(full_graph.mapped_triples, full_graph.num_entities, full_graph.num_relations)
         else:
             all_triples, all_triples_set, entity_to_id_map, relation_to_id_map, test_triples, validation_triples = emb.getDataFromPykeen(datasetname=datasetname)
             full_dataset = torch.cat((all_triples, test_triples.mapped_triples, validation_triples.mapped_triples))
@@ -1317,30 +1209,35 @@ def densestSubgraph(datasetname, embedding, score_calculation, sample, models):
         for t in df.values:
             M.add_edge(t[0], t[2], label = t[1])
 
+        clearNegScoreCache()
         G = nx.Graph()
         count = 0
         pct = 0
         start = timeit.default_timer()
-        length: int = len(nx.DiGraph(M).edges())
+        edges = dh.EdgeProjection.fromGraph(M).edges()
+        length: int = len(edges)
         print(f'Starting with {length}')
-        if parallel_uv is True:
-            perm_relations, perm_entities = pre_randperm(full_graph.num_entities, full_graph.num_relations)
-        for u,v in nx.DiGraph(M).edges():
-            w,tailRR,relationRR = score_calculation(u, v, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname)
-            if G.has_edge(u,v):
-                G[u][v]['weight'] += w
-                G[u][v]['tailRR'] += tailRR
-                G[u][v]['relationRR'] += relationRR
-            else:
-                G.add_edge(u, v, weight=w)
-                G.add_edge(u, v, tailRR=tailRR)
-                G.add_edge(u, v, relationRR=relationRR)
-            count += 1
-            now = timeit.default_timer()
-            if count % ((length // 100)+1) == 0:
-                pct += 1
+        perm_entities, perm_relations = None, None
+        if score_calculation.__name__ == 'binomial_cuda':
+            perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations, device=device)
+        for batch_start in range(0, len(edges), edge_batch_size):
+            edge_batch = edges[batch_start:batch_start+edge_batch_size]
+            scores = scoreEdgeBatch(score_calculation, edge_batch, M, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, sample, datasetname, device, perm_entities, perm_relations)
+            for (u,v), (w,tailRR,relationRR) in zip(edge_batch, scores):
+                if G.has_edge(u,v):
+                    G[u][v]['weight'] += w
+                    G[u][v]['tailRR'] += tailRR
+                    G[u][v]['relationRR'] += relationRR
+                else:
+                    G.add_edge(u, v, weight=w)
+                    G.add_edge(u, v, tailRR=tailRR)
+                    G.add_edge(u, v, relationRR=relationRR)
+                count += 1
                 now = timeit.default_timer()
-                print(f'Finished with {pct}% for {datasetname} in time {now-start}, took avg of {(now-start)/pct} per point')
+                if count % ((length // 100)+1) == 0:
+                    pct += 1
+                    now = timeit.default_timer()
+                    print(f'Finished with {pct}% for {datasetname} in time {now-start}, took avg of {(now-start)/pct} per point')
             #if(pct == 5):
             #    break
 
@@ -1352,14 +1249,22 @@ def densestSubgraph(datasetname, embedding, score_calculation, sample, models):
             wr = csv.writer(f)
             wr.writerows(weighted_graph)
 
-def RR(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: set[tuple[int,int,int]], alltriples: TriplesFactory, sample: float, dataset: str) -> float:
+def negativeTailTriples(all_triples_set: ti.TripleIndex, head: int, relation: int) -> torch.Tensor:
+    '''
+    all (head, relation, t) that are not a known triple, as (N,3) LongTensor
+    '''
+    tails = all_triples_set.negativeTails(head, relation)
+    return torch.stack((torch.full_like(tails, head), torch.full_like(tails, relation), tails), dim=1)
+
+def RR(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_map: object, relation_to_id_map: object, all_triples_set: ti.TripleIndex, alltriples: TriplesFactory, sample: float, dataset: str) -> float:
     '''
     get reciprocal rank scores
     '''
-    subgraph_list, labels, existing, count, ex_triples  = dh.getkHopneighbors(u,v,M)
+    existing = dh.getEdgeLabels(u,v,M)
     head = entity_to_id_map[u]
     tail = entity_to_id_map[v]
-    list_relation = torch.tensor([[head,i,tail] for i in range(models[0].num_relations) if (head,i, tail) not in all_triples_set ])
+    relations = all_triples_set.negativeRelations(head, tail)
+    list_relation = torch.stack((torch.full_like(relations, head), relations, torch.full_like(relations, tail)), dim=1)
 
     first = True
     for tp in list(existing):
@@ -1368,24 +1273,19 @@ def RR(u: str, v: str, M: nx.MultiDiGraph, models: list[object], entity_to_id_ma
             print([u,tp,v])
             ex_torch = torch.LongTensor([head,relation_to_id_map[tp],tail])
             ex_torch = ex_torch.resize_(1,3)
-            list_tail = [torch.tensor([[head,relation_to_id_map[tp],i] for i in range(models[0].num_entities) if (head,relation_to_id_map[tp], i) not in all_triples_set ])]
+            list_tail = [negativeTailTriples(all_triples_set, head, relation_to_id_map[tp])]
         else:
             ex_torch = torch.cat((ex_torch, torch.LongTensor([head,relation_to_id_map[tp],tail]).resize_(1,3)))
-            list_tail = list_tail + [torch.tensor([[head,relation_to_id_map[tp],i] for i in range(models[0].num_entities) if (head,relation_to_id_map[tp], i) not in all_triples_set ])]
+            list_tail = list_tail + [negativeTailTriples(all_triples_set, head, relation_to_id_map[tp])]
+    tail_seg = torch.repeat_interleave(torch.arange(len(list_tail)), torch.LongTensor([len(neg) for neg in list_tail]))
     hRankNeg = 0.
     tRankNeg = 0.
     for i in range(len(models)):
-        comp_score = models[i].score_hrt(ex_torch).cpu()
+        comp_score = models[i].score_hrt(ex_torch).detach().flatten()
         
-        rslt_v_score = models[i].score_hrt(list_relation).cpu()
-        count = 0
-        he_sc = 0
-        ta_sc = 0
-        for tr in comp_score:
-            rslt_u_score = models[i].score_hrt(list_tail[count]).cpu()
-            count += 1
-            he_sc += torch.sum(rslt_u_score > tr).detach().numpy() + 1
-            ta_sc += torch.sum(rslt_v_score > tr).detach().numpy() + 1
+        # every positive has its own negative tails, all of them are scored together and counted per positive
+        he_sc = torch.sum(countHigherStreamed(models[i], torch.cat(list_tail), comp_score, tail_seg, torch.arange(len(list_tail)), len(list_tail)) + 1).item()
+        ta_sc = torch.sum(countHigherStreamed(models[i], list_relation, comp_score) + 1).item()
         hRankNeg += he_sc / len(models)
         tRankNeg += ta_sc / len(models)
 
@@ -1402,6 +1302,9 @@ if __name__ == "__main__":
     parser.add_argument('-heur','--heuristic', dest='heuristic', type=str, help='which heuristic should be used in the case of dense subgraph task')
     parser.add_argument('-r','--ratio', dest='ratio', type=str, help='how much should be sampled for binomial', default=0.1)
     parser.add_argument('-c','--class', dest='classifier', type=str, help='classifier type')
+    parser.add_argument('-dev','--device', dest='device', type=str, help='device for scoring and sampling, e.g. cpu or cuda:0, detected automatically if not set')
+    parser.add_argument('-fw','--fold_workers', dest='fold_workers', type=int, help='number of processes working on the folds at once for training, ranking and triple classification', default=1)
+    parser.add_argument('-cb','--candidate_batch', dest='candidate_batch', type=int, help='if set, number of negative candidates scored at once to bound the memory of the scoring')
     args = parser.parse_args()
 
     nmb_KFold: int = 5
@@ -1486,7 +1389,10 @@ if __name__ == "__main__":
         classifier = args.classifier
     '''if torch.has_mps:
         device = 'mps'''
-    device = 'cpu'
+    device = resolveDevice(args.device)
+    if args.candidate_batch:
+        candidate_batch_size = args.candidate_batch
+    fold_workers = args.fold_workers
     #print(heuristic)
     path = f"approach/scoreData/{args.dataset_name}_{nmb_KFold}/{args.embedding}"
     isExist = os.path.exists(path)
@@ -1515,10 +1421,10 @@ if __name__ == "__main__":
             if len(subgraphs) > n_subgraphs:
                     subgraphs = subgraphs[:n_subgraphs]
     else:
-        models = [emb.loadModel(f"Yago2",'mps')]
+        models = [emb.loadModel(f"Yago2",device)]
 
     if parallel_uv == True:
-        perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations)
+        perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations, device=device)
 
 
     tstamp_sib = -1
@@ -1535,7 +1441,7 @@ if __name__ == "__main__":
         writer = csv.writer(c)
         """
         start = timeit.default_timer()
-        densestSubgraph(args.dataset_name, args.embedding, getReliKScore, ratio, models)
+        densestSubgraph(args.dataset_name, args.embedding, getReliKScore, ratio, models, device)
         end = timeit.default_timer()
         data = ['accurate', ratio, end-start]
         writer.writerow(data)
@@ -1546,9 +1452,7 @@ if __name__ == "__main__":
             print(f'sampling ratio = {ratio}')
             start = timeit.default_timer()
             # DoGlobalReliKScore(args.embedding, args.dataset_name, nmb_KFold, size_subgraphs, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, ratio, heuristic)
-            if args.heuristic == 'binomial-cuda':
-                perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations)
-            densestSubgraph(args.dataset_name, args.embedding, heuristic, ratio, models)
+            densestSubgraph(args.dataset_name, args.embedding, heuristic, ratio, models, device)
             end = timeit.default_timer()
             data = [f'{args.heuristic}', ratio, end-start]
             print(data)
@@ -1567,7 +1471,7 @@ if __name__ == "__main__":
     if 'ReliK' in task_list:
         print('start with ReliK')
         start = timeit.default_timer()
-        DoGlobalReliKScore(args.embedding, args.dataset_name, nmb_KFold, size_subgraphs, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, ratio, heuristic)
+        DoGlobalReliKScore(args.embedding, args.dataset_name, nmb_KFold, size_subgraphs, models, entity_to_id_map, relation_to_id_map, all_triples_set, full_graph, ratio, heuristic, device)
         end = timeit.default_timer()
         print('end with ReliK')
         tstamp_sib = end - start
@@ -1588,9 +1492,7 @@ if __name__ == "__main__":
         tstamp_tpc = end - start
     if 'densest' in task_list:
         start = timeit.default_timer()
-        if args.heuristic == 'binomial-cuda':
-            perm_entities, perm_relations = pre_randperm(full_graph.num_entities, full_graph.num_relations)
-        densestSubgraph(args.dataset_name, args.embedding, heuristic, ratio, models)
+        densestSubgraph(args.dataset_name, args.embedding, heuristic, ratio, models, device)
         end = timeit.default_timer()
         tstamp_den = end - start
     if 'randomsample' in task_list:
@@ -1601,7 +1503,7 @@ if __name__ == "__main__":
         c = open(f'{path}', "a+")
         writer = csv.writer(c)
         start = timeit.default_timer()
-        densestSubgraph(args.dataset_name, args.embedding, getReliKScore, ratio, models)
+        densestSubgraph(args.dataset_name, args.embedding, getReliKScore, ratio, models, device)
         end = timeit.default_timer()
         data = ['accurate', ratio, end-start]
         writer.writerow(data)
@@ -1610,13 +1512,13 @@ if __name__ == "__main__":
         for rat in [0.05,0.1,0.15,0.2,0.25,0.3,0.35,0.4,0.45,0.5,0.55,0.6,0.65,0.7,0.75,0.8,0.85,0.9,0.95,1.0]:
             ratio = rat
             start = timeit.default_timer()
-            densestSubgraph(args.dataset_name, args.embedding, lower_bound, ratio, models)
+            densestSubgraph(args.dataset_name, args.embedding, lower_bound, ratio, models, device)
             end = timeit.default_timer()
             data = ['lower_bound', ratio, end-start]
             writer.writerow(data)
 
             start = timeit.default_timer()
-            densestSubgraph(args.dataset_name, args.embedding, binomial, ratio, models)
+            densestSubgraph(args.dataset_name, args.embedding, binomial, ratio, models, device)
             end = timeit.default_timer()
             data = ['binomial', ratio, end-start]
             writer.writerow(data)
@@ -40,59 +40,19 @@ def naiveTripleCLassification(LP_triples_pos, LP_triples_neg, entity_to_id_map,
     '''
     LP_test_score = []
     X_train_pos, X_test_pos, y_train_pos, y_test_pos, X_train_neg, X_test_neg, y_train_neg, y_test_neg = cla.prepareTrainTestDataSplit(LP_triples_pos, LP_triples_neg, emb_train_triples, entity_to_id_map, relation_to_id_map)
-    first = True
-    for i in range(len(X_train_pos)):
-        if first:
-            first = False
-            rslt_torch_pos = X_train_pos[i][0]
-            rslt_torch_pos = rslt_torch_pos.resize_(1,3)
-            
-        else:
-            rslt_torch_pos = torch.cat((rslt_torch_pos,  X_train_pos[i][0].resize_(1,3)))
-    first = True
-    for i in range(len(X_train_neg)):
-        if first:
-            first = False
-            rslt_torch_neg = X_train_neg[i][0]
-            rslt_torch_neg = rslt_torch_neg.resize_(1,3)
-            
-        else:
-            rslt_torch_neg = torch.cat((rslt_torch_neg,  X_train_neg[i][0].resize_(1,3)))
-    comp_score_pos = model.score_hrt(rslt_torch_pos)
-    comp_score_neg = model.score_hrt(rslt_torch_neg)
+    comp_score_pos = model.score_hrt(X_train_pos)
+    comp_score_neg = model.score_hrt(X_train_neg)
 
-    first = True
-    for i in range(torch.sum(comp_score_neg > torch.min(comp_score_pos)).cpu().detach().numpy()):
-        k = torch.topk(comp_score_neg, i+1, dim=-2)
-        pos_low = torch.sum(comp_score_pos < k.values[i]).cpu().detach().numpy()
-        neg_hig = torch.sum(comp_score_neg > k.values[i]).cpu().detach().numpy()
-        if first:
-            min_false = pos_low + neg_hig
-            first = False
-        if min_false > neg_hig + pos_low:
-            thresh = k.values[i]
-            min_false = neg_hig + pos_low
-    first = True
+    thresh = cla.bestThreshold(comp_score_pos, comp_score_neg)
     for subgraph in subgraphs:
-        for tp in X_test_pos:
-            if ((emb_train_triples.entity_id_to_label[tp[0][0].item()] in subgraph) or (emb_train_triples.entity_id_to_label[tp[0][2].item()] in subgraph)):
-                if first:
-                    first = False
-                    rslt_torch_pos = tp[0]
-                    rslt_torch_pos = rslt_torch_pos.resize_(1,3)
-                else:
-                    rslt_torch_pos = torch.cat((rslt_torch_pos, tp[0].resize_(1,3)))
-        first = True
-        for tp in X_test_neg:
-            if ((emb_train_triples.entity_id_to_label[tp[0][0].item()] in subgraph) or (emb_train_triples.entity_id_to_label[tp[0][2].item()] in subgraph)):
-                if first:
-                    first = False
-                    rslt_torch_neg = tp[0]
-                    rslt_torch_neg = rslt_torch_neg.resize_(1,3)
-                else:
-                    rslt_torch_neg = torch.cat((rslt_torch_neg, tp[0].resize_(1,3)))
-    
-        
+        in_subgraph = cla.entityMask(subgraph, entity_to_id_map, emb_train_triples.num_entities)
+        rslt_torch_pos = X_test_pos[in_subgraph[X_test_pos[:,0]] | in_subgraph[X_test_pos[:,2]]]
+        rslt_torch_neg = X_test_neg[in_subgraph[X_test_neg[:,0]] | in_subgraph[X_test_neg[:,2]]]
+        if rslt_torch_pos.shape[0] + rslt_torch_neg.shape[0] == 0:
+            # no test triple touches the subgraph
+            LP_test_score.append(-100)
+            continue
+
         comp_score_pos = model.score_hrt(rslt_torch_pos)
         comp_score_neg = model.score_hrt(rslt_torch_neg)
             
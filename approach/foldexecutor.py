@@ -0,0 +1,24 @@
+import os
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+def initFoldWorker(threads: int):
+    '''
+    split the cores between the fold workers instead of every worker using all of them
+    '''
+    torch.set_num_threads(threads)
+
+def runFolds(fold_function, fold_args: list[tuple], workers: int=1) -> list:
+    '''
+    run fold_function(*args) for the args of every fold, with workers > 1 in that many processes
+    the results are returned in order of fold_args, no matter which fold finishes first
+    fold_function has to be defined on module level and args must be picklable
+    '''
+    if workers <= 1 or len(fold_args) <= 1:
+        return [fold_function(*args) for args in fold_args]
+    workers = min(workers, len(fold_args))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'), initializer=initFoldWorker, initargs=(threads,)) as executor:
+        futures = [executor.submit(fold_function, *args) for args in fold_args]
+        return [future.result() for future in futures]
@@ -0,0 +1,40 @@
+import numpy as np
+
+# degrees of the index last given to degrees(), computed once per index
+degree_index = None
+out_degree = None
+in_degree = None
+
+def degrees(all_triples_set) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    per entity number of distinct (relation, tail) with the entity as head (out-degree)
+    and of distinct (head, relation) with the entity as tail (in-degree) in a TripleIndex
+    '''
+    global degree_index
+    global out_degree
+    global in_degree
+    if degree_index is not all_triples_set:
+        out_degree = np.diff(all_triples_set.head_ptr)
+        in_degree = np.diff(all_triples_set.tail_ptr)
+        degree_index = all_triples_set
+    return out_degree, in_degree
+
+def outDegree(all_triples_set, entity: int) -> int:
+    '''
+    number of known triples with the entity as head
+    '''
+    return int(degrees(all_triples_set)[0][entity])
+
+def inDegree(all_triples_set, entity: int) -> int:
+    '''
+    number of known triples with the entity as tail
+    '''
+    return int(degrees(all_triples_set)[1][entity])
+
+def negativeCount(all_triples_set, entity: int, side: str='head') -> int:
+    '''
+    number of (relation, entity) combinations for a fixed head (side='head') or tail (side='tail') that are not a known triple
+    '''
+    if side == 'head':
+        return all_triples_set.num_entities * all_triples_set.num_relations - outDegree(all_triples_set, entity)
+    return all_triples_set.num_entities * all_triples_set.num_relations - inDegree(all_triples_set, entity)
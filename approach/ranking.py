@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+
+# number of test triples that are ranked together
+ranking_batch_size = 256
+
+def filteredRanks(model, triples, all_triples_set, side: str='tail', batch_size: int=None) -> torch.Tensor:
+    '''
+    filtered rank of the tail (side='tail'), head (side='head') or relation (side='relation') of every test triple
+    all candidates of a batch of triples are scored at once with score_t, score_h or score_r,
+    known triples are masked out with the triple index, the rank is one plus the number of candidates scoring strictly higher
+    '''
+    triples = torch.as_tensor(triples, dtype=torch.long).reshape(-1, 3)
+    batch_size = batch_size or ranking_batch_size
+    ranks = []
+    for start in range(0, triples.shape[0], batch_size):
+        batch = triples[start:start+batch_size]
+        true_scores = model.score_hrt(batch.to(model.device)).detach()
+        if side == 'tail':
+            scores = model.score_t(batch[:, :2].to(model.device)).detach()
+            rows, known = all_triples_set.knownTailsBatch(batch[:, 0].numpy(), batch[:, 1].numpy())
+        elif side == 'head':
+            scores = model.score_h(batch[:, 1:].to(model.device)).detach()
+            rows, known = all_triples_set.knownHeadsBatch(batch[:, 1].numpy(), batch[:, 2].numpy())
+        else:
+            scores = model.score_r(batch[:, [0, 2]].to(model.device)).detach()
+            rows, known = all_triples_set.knownRelationsBatch(batch[:, 0].numpy(), batch[:, 2].numpy())
+        scores[torch.from_numpy(rows), torch.from_numpy(known)] = float('-inf')
+        ranks.append(torch.sum(scores > true_scores, dim=1).cpu() + 1)
+    if len(ranks) == 0:
+        return torch.zeros(0, dtype=torch.long)
+    return torch.cat(ranks)
+
+def hitsAndMRR(ranks: torch.Tensor) -> tuple[float,float,float,float]:
+    '''
+    Hits@1, Hits@5, Hits@10 and MRR of the given ranks
+    '''
+    ranks = ranks.double()
+    return torch.mean((ranks <= 1).double()).item(), torch.mean((ranks <= 5).double()).item(), torch.mean((ranks <= 10).double()).item(), torch.mean(1 / ranks).item()
+
+def subgraphHitsAndMRR(fold_ranks: list[torch.Tensor], fold_pairs: list[tuple[np.ndarray, np.ndarray]], num_subgraphs: int) -> np.ndarray:
+    '''
+    Hits@1, Hits@5, Hits@10 and MRR per subgraph as (4, num_subgraphs) array, the mean over the folds with a test triple in the subgraph
+    fold_pairs[i] = (rows, subgraphs) tells which ranks of fold i belong to which subgraph, subgraphs without test triples get -100
+    '''
+    sums = np.zeros((4, num_subgraphs))
+    measured = np.zeros(num_subgraphs)
+    for ranks, (rows, subgraphs) in zip(fold_ranks, fold_pairs):
+        ranks = ranks.numpy()[rows].astype(np.float64)
+        count = np.bincount(subgraphs, minlength=num_subgraphs)
+        values = np.stack([np.bincount(subgraphs, weights=weights, minlength=num_subgraphs) for weights in (ranks <= 1, ranks <= 5, ranks <= 10, 1 / ranks)])
+        has = count > 0
+        sums[:, has] += values[:, has] / count[has]
+        measured += has
+    scores = np.full((4, num_subgraphs), -100.0)
+    scores[:, measured > 0] = sums[:, measured > 0] / measured[measured > 0]
+    return scores
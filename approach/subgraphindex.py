@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+class SubgraphIndex:
+    '''
+    Sparse entity x subgraph incidence of a list of subgraphs (sets of entity labels), built once and shared by the evaluators
+    For every entity the ids of the subgraphs containing it are stored as sorted keys entity*num_subgraphs+subgraph (CSR layout)
+    '''
+    def __init__(self, subgraphs):
+        self.num_subgraphs = len(subgraphs)
+        entities = [entity for subgraph in subgraphs for entity in subgraph]
+        subgraph_ids = np.repeat(np.arange(len(subgraphs)), [len(subgraph) for subgraph in subgraphs])
+        codes, self.entities = pd.factorize(np.asarray(entities, dtype=object))
+        self.entity_id = {entity: i for i, entity in enumerate(self.entities)}
+        # sorted distinct keys entity*num_subgraphs+subgraph, also used for the membership test
+        self.keys = np.unique(codes * self.num_subgraphs + subgraph_ids)
+        self.ptr = np.zeros(len(self.entities) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.keys // self.num_subgraphs, minlength=len(self.entities)), out=self.ptr[1:])
+        self.subgraph_ids = self.keys % self.num_subgraphs
+
+    def _ids(self, entities) -> np.ndarray:
+        return np.array([self.entity_id.get(entity, -1) for entity in entities], dtype=np.int64)
+
+    def _memberships(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (position, subgraph) for every subgraph that contains the entity at a position
+        known = np.flatnonzero(ids >= 0)
+        starts = self.ptr[ids[known]]
+        counts = self.ptr[ids[known] + 1] - starts
+        rows = np.repeat(known, counts)
+        return rows, self.subgraph_ids[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+    def _contains(self, ids: np.ndarray, subgraphs: np.ndarray) -> np.ndarray:
+        return (ids >= 0) & np.isin(ids * self.num_subgraphs + subgraphs, self.keys)
+
+    def subgraphsOf(self, entity) -> np.ndarray:
+        '''
+        ids of all subgraphs that contain the entity
+        '''
+        if entity not in self.entity_id:
+            return np.zeros(0, dtype=np.int64)
+        i = self.entity_id[entity]
+        return self.subgraph_ids[self.ptr[i]:self.ptr[i+1]]
+
+    def inducedPairs(self, heads, tails) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        all (triple, subgraph) pairs with head and tail of the triple in the subgraph, as triple positions and subgraph ids
+        '''
+        tail_ids = self._ids(tails)
+        rows, subgraphs = self._memberships(self._ids(heads))
+        # keep the subgraphs of the head that also contain the tail
+        inside = self._contains(tail_ids[rows], subgraphs)
+        return rows[inside], subgraphs[inside]
+
+    def incidentPairs(self, heads, tails) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        all (triple, subgraph) pairs with head or tail of the triple in the subgraph, as triple positions and subgraph ids
+        '''
+        head_ids = self._ids(heads)
+        head_rows, head_subgraphs = self._memberships(head_ids)
+        tail_rows, tail_subgraphs = self._memberships(self._ids(tails))
+        # a subgraph with head and tail is already counted for the head
+        only_tail = ~self._contains(head_ids[tail_rows], tail_subgraphs)
+        rows = np.concatenate((head_rows, tail_rows[only_tail]))
+        subgraphs = np.concatenate((head_subgraphs, tail_subgraphs[only_tail]))
+        order = np.lexsort((subgraphs, rows))
+        return rows[order], subgraphs[order]
+
+def subgraphIndex(subgraphs) -> SubgraphIndex:
+    '''
+    the subgraphs as SubgraphIndex, an already built index is used as it is
+    '''
+    if isinstance(subgraphs, SubgraphIndex):
+        return subgraphs
+    return SubgraphIndex(subgraphs)
+
+def groupPairs(pairs: tuple[np.ndarray, np.ndarray], values, num_subgraphs: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    number of triples and sum of their values per subgraph, for (triple, subgraph) pairs and one value per triple
+    '''
+    rows, subgraphs = pairs
+    counts = np.bincount(subgraphs, minlength=num_subgraphs)
+    sums = np.bincount(subgraphs, weights=np.asarray(values, dtype=np.float64)[rows], minlength=num_subgraphs)
+    return counts, sums
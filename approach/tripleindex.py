@@ -0,0 +1,231 @@
+import numpy as np
+import torch
+from multiprocessing import shared_memory
+
+class TripleIndex:
+    '''
+    Index of all known triples of a KG, used instead of a python set of (head, relation, tail) tuples
+    For every head the known (relation, tail) pairs are stored as sorted keys relation*num_entities+tail,
+    for every tail the known (relation, head) pairs as relation*num_entities+head (CSR layout)
+    '''
+    def __init__(self, triples, num_entities: int, num_relations: int):
+        if isinstance(triples, torch.Tensor):
+            triples = triples.cpu().numpy()
+        elif isinstance(triples, (set, frozenset)):
+            triples = list(triples)
+        triples = np.unique(np.asarray(triples, dtype=np.int64).reshape(-1, 3), axis=0)
+
+        self.num_entities = num_entities
+        self.num_relations = num_relations
+        self.num_triples = triples.shape[0]
+
+        head, relation, tail = triples[:, 0], triples[:, 1], triples[:, 2]
+        self.head_ptr, self.head_key = self._buildSide(head, relation * num_entities + tail)
+        self.tail_ptr, self.tail_key = self._buildSide(tail, relation * num_entities + head)
+
+    def _buildSide(self, fix, key):
+        order = np.lexsort((key, fix))
+        ptr = np.zeros(self.num_entities + 1, dtype=np.int64)
+        np.cumsum(np.bincount(fix, minlength=self.num_entities), out=ptr[1:])
+        return ptr, key[order]
+
+    # arrays that make up the index, shared between processes by share() and attach()
+    shared_arrays = ('head_ptr', 'head_key', 'tail_ptr', 'tail_key')
+
+    def share(self) -> dict:
+        '''
+        copy the index arrays into shared memory and return a small picklable handle for TripleIndex.attach
+        the blocks belong to this process and are freed with unlink() once the workers are done
+        '''
+        self.shared_blocks = []
+        handle = {'num_entities': self.num_entities, 'num_relations': self.num_relations, 'num_triples': self.num_triples, 'arrays': {}}
+        for name in self.shared_arrays:
+            array = getattr(self, name)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self.shared_blocks.append(block)
+            handle['arrays'][name] = (block.name, array.shape, array.dtype.str)
+        return handle
+
+    @classmethod
+    def attach(cls, handle: dict) -> 'TripleIndex':
+        '''
+        index on top of the shared memory of handle, without copying the arrays, it must not be changed
+        '''
+        index = cls.__new__(cls)
+        index.num_entities = handle['num_entities']
+        index.num_relations = handle['num_relations']
+        index.num_triples = handle['num_triples']
+        index.shared_blocks = []
+        for name, (block_name, shape, dtype) in handle['arrays'].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            setattr(index, name, array)
+            index.shared_blocks.append(block)
+        return index
+
+    def unlink(self):
+        '''
+        free the shared memory created by share()
+        '''
+        for block in getattr(self, 'shared_blocks', []):
+            block.close()
+            block.unlink()
+        self.shared_blocks = []
+
+    def __len__(self):
+        return self.num_triples
+
+    def __contains__(self, triple):
+        keys = self.knownKeys(int(triple[0]), 'head')
+        key = int(triple[1]) * self.num_entities + int(triple[2])
+        pos = np.searchsorted(keys, key)
+        return bool(pos < keys.shape[0] and keys[pos] == key)
+
+    def __iter__(self):
+        head = np.repeat(np.arange(self.num_entities), np.diff(self.head_ptr))
+        relation = self.head_key // self.num_entities
+        tail = self.head_key % self.num_entities
+        return zip(head.tolist(), relation.tolist(), tail.tolist())
+
+    def contains(self, triples) -> np.ndarray:
+        '''
+        vectorized membership test, returns a boolean mask telling which of the (N,3) triples are known
+        '''
+        if isinstance(triples, torch.Tensor):
+            triples = triples.cpu().numpy()
+        triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+        if self.num_triples == 0:
+            return np.zeros(triples.shape[0], dtype=bool)
+        head = triples[:, 0]
+        key = triples[:, 1] * self.num_entities + triples[:, 2]
+        end = self.head_ptr[head + 1]
+        lo = self._lowerBound(self.head_key, self.head_ptr[head], end, key)
+        return (lo < end) & (self.head_key[np.minimum(lo, self.num_triples - 1)] == key)
+
+    def _lowerBound(self, keys: np.ndarray, lo: np.ndarray, hi: np.ndarray, target: np.ndarray) -> np.ndarray:
+        # vectorized binary search, first position in every slice keys[lo:hi] with a key not smaller than its target
+        lo = lo.copy()
+        hi = hi.copy()
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            right = active & (keys[np.minimum(mid, max(len(keys) - 1, 0))] < target)
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+        return lo
+
+    def _slicePositions(self, lo: np.ndarray, hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # row and position of every element of the slices [lo, hi)
+        counts = hi - lo
+        rows = np.repeat(np.arange(len(lo)), counts)
+        return rows, np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    def knownKeys(self, entity: int, side: str='head') -> np.ndarray:
+        '''
+        sorted keys of all known triples with the given entity as head (side='head') or as tail (side='tail')
+        '''
+        if side == 'head':
+            return self.head_key[self.head_ptr[entity]:self.head_ptr[entity+1]]
+        return self.tail_key[self.tail_ptr[entity]:self.tail_ptr[entity+1]]
+
+    def _knownWithRelation(self, entity: int, relation: int, side: str) -> np.ndarray:
+        keys = self.knownKeys(entity, side)
+        lo, hi = np.searchsorted(keys, [relation * self.num_entities, (relation + 1) * self.num_entities])
+        return keys[lo:hi] - relation * self.num_entities
+
+    def _knownWithRelationBatch(self, entities, relations, side: str) -> tuple[np.ndarray, np.ndarray]:
+        entities = np.asarray(entities, dtype=np.int64)
+        relations = np.asarray(relations, dtype=np.int64)
+        ptr, keys = (self.head_ptr, self.head_key) if side == 'head' else (self.tail_ptr, self.tail_key)
+        lo = self._lowerBound(keys, ptr[entities], ptr[entities + 1], relations * self.num_entities)
+        hi = self._lowerBound(keys, ptr[entities], ptr[entities + 1], (relations + 1) * self.num_entities)
+        rows, pos = self._slicePositions(lo, hi)
+        return rows, keys[pos] - relations[rows] * self.num_entities
+
+    def knownTailsBatch(self, heads, relations) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        all known (heads[i], relations[i], t) of a batch, as row i and tail t
+        '''
+        return self._knownWithRelationBatch(heads, relations, 'head')
+
+    def knownHeadsBatch(self, relations, tails) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        all known (h, relations[i], tails[i]) of a batch, as row i and head h
+        '''
+        return self._knownWithRelationBatch(tails, relations, 'tail')
+
+    def knownRelationsBatch(self, heads, tails) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        all known (heads[i], r, tails[i]) of a batch, as row i and relation r
+        '''
+        heads = np.asarray(heads, dtype=np.int64)
+        tails = np.asarray(tails, dtype=np.int64)
+        rows, pos = self._slicePositions(self.head_ptr[heads], self.head_ptr[heads + 1])
+        keys = self.head_key[pos]
+        match = keys % self.num_entities == tails[rows]
+        return rows[match], keys[match] // self.num_entities
+
+    def knownTails(self, head: int, relation: int) -> np.ndarray:
+        '''
+        all tails t with (head, relation, t) being a known triple
+        '''
+        return self._knownWithRelation(head, relation, 'head')
+
+    def knownHeads(self, relation: int, tail: int) -> np.ndarray:
+        '''
+        all heads h with (h, relation, tail) being a known triple
+        '''
+        return self._knownWithRelation(tail, relation, 'tail')
+
+    def knownRelations(self, head: int, tail: int) -> np.ndarray:
+        '''
+        all relations r with (head, r, tail) being a known triple
+        '''
+        keys = self.knownKeys(head, 'head')
+        return keys[keys % self.num_entities == tail] // self.num_entities
+
+    def _unknown(self, known: np.ndarray, size: int) -> torch.Tensor:
+        mask = np.ones(size, dtype=bool)
+        mask[known] = False
+        return torch.from_numpy(np.flatnonzero(mask))
+
+    def negativeTails(self, head: int, relation: int) -> torch.Tensor:
+        '''
+        all tails t with (head, relation, t) not being a known triple
+        '''
+        return self._unknown(self.knownTails(head, relation), self.num_entities)
+
+    def negativeHeads(self, relation: int, tail: int) -> torch.Tensor:
+        '''
+        all heads h with (h, relation, tail) not being a known triple
+        '''
+        return self._unknown(self.knownHeads(relation, tail), self.num_entities)
+
+    def negativeRelations(self, head: int, tail: int) -> torch.Tensor:
+        '''
+        all relations r with (head, r, tail) not being a known triple
+        '''
+        return self._unknown(self.knownRelations(head, tail), self.num_relations)
+
+    def negativeKeys(self, entity: int, side: str='head') -> torch.Tensor:
+        '''
+        keys relation*num_entities+other of all (relation, other) combinations for a fixed head or tail that are not a known triple
+        '''
+        mask = np.ones(self.num_relations * self.num_entities, dtype=bool)
+        mask[self.knownKeys(entity, side)] = False
+        return torch.from_numpy(np.flatnonzero(mask))
+
+    def negativeTriples(self, entity: int, side: str='head') -> torch.Tensor:
+        '''
+        all (relation, entity) combinations for a fixed head or tail that are not a known triple, as (N,3) LongTensor
+        '''
+        keys = self.negativeKeys(entity, side).numpy()
+        relation = keys // self.num_entities
+        other = keys % self.num_entities
+        fixed = np.full_like(keys, entity)
+        if side == 'head':
+            return torch.from_numpy(np.stack((fixed, relation, other), axis=1))
+        return torch.from_numpy(np.stack((other, relation, fixed), axis=1))